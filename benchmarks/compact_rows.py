@@ -0,0 +1,79 @@
+"""
+Compares fetching of rows as model objects and as CompactObject.
+
+Usage: python benchmarks/compact_rows.py postgres://localhost/dbname [rows]
+"""
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+
+import asyncpgsa
+import sqlalchemy as sa
+
+from dvhb_hybrid.amodels import Model
+
+
+class BenchmarkRow(Model):
+    table = sa.table(
+        'benchmark_compact_rows',
+        sa.column('id', sa.Integer),
+        sa.column('title', sa.Text),
+        sa.column('value', sa.Integer),
+        sa.column('created', sa.DateTime),
+    )
+
+
+async def prepare(connection, rows):
+    await connection.execute(
+        'CREATE TABLE IF NOT EXISTS benchmark_compact_rows '
+        '(id serial PRIMARY KEY, title text, value integer, created timestamp)')
+    if await connection.fetchval('SELECT count(*) FROM benchmark_compact_rows') != rows:
+        await connection.execute('TRUNCATE benchmark_compact_rows')
+        await connection.execute(
+            'INSERT INTO benchmark_compact_rows (title, value, created) '
+            'SELECT md5(i::text), i, now() FROM generate_series(1, $1) i', rows)
+
+
+async def fetch(connection, compact):
+    result = await BenchmarkRow.get_list(connection=connection, compact=compact)
+    total = 0
+    for i in result:
+        total += i.value
+    return result
+
+
+async def measure(connection, compact):
+    gc.collect()
+    started = time.perf_counter()
+    await fetch(connection, compact)
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    tracemalloc.start()
+    result = await fetch(connection, compact)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, current, peak
+
+
+async def main(dsn, rows):
+    async with asyncpgsa.create_pool(dsn, min_size=1, max_size=1) as pool:
+        async with pool.acquire() as connection:
+            await prepare(connection, rows)
+            print('{:<10} {:>10} {:>14} {:>14}'.format('objects', 'time, s', 'retained, MB', 'peak, MB'))
+            for compact in (False, True, False, True):
+                elapsed, current, peak = await measure(connection, compact)
+                print('{:<10} {:>10.3f} {:>14.1f} {:>14.1f}'.format(
+                    'compact' if compact else 'model',
+                    elapsed, current / 2 ** 20, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.get_event_loop().run_until_complete(
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100000))
@@ -0,0 +1,60 @@
+"""
+Compares access to fields of model objects by attributes
+through column descriptors and through __getattr__ fallback.
+Assignment goes through Model.__setattr__ in both cases.
+
+Usage: python benchmarks/model_attributes.py [objects]
+"""
+import sys
+import timeit
+
+import sqlalchemy as sa
+
+from dvhb_hybrid.amodels import Model
+
+COLUMNS = ('id', 'title', 'value', 'created')
+
+
+class BenchmarkDescriptors(Model):
+    table = sa.table('benchmark_attributes', *(sa.column(k) for k in COLUMNS))
+
+
+class BenchmarkFallback(Model):
+    pass
+
+
+# Table is set after creation of the class, so columns have no descriptors
+BenchmarkFallback.table = BenchmarkDescriptors.table
+
+
+def read(objects):
+    total = 0
+    for i in objects:
+        total += i.value
+        i.title
+        i.created
+    return total
+
+
+def assign(objects):
+    for i in objects:
+        i.value = 1
+        i.title = 'title'
+
+
+def main(count):
+    print('{:<12} {:>12} {:>12}'.format('attributes', 'read, s', 'assign, s'))
+    for model in (BenchmarkFallback, BenchmarkDescriptors, BenchmarkFallback, BenchmarkDescriptors):
+        objects = [
+            model(id=i, title=str(i), value=i, created=None)
+            for i in range(count)
+        ]
+        read_time = min(timeit.repeat(lambda: read(objects), number=1, repeat=5))
+        assign_time = min(timeit.repeat(lambda: assign(objects), number=1, repeat=5))
+        print('{:<12} {:>12.3f} {:>12.3f}'.format(
+            'descriptors' if model is BenchmarkDescriptors else 'fallback',
+            read_time, assign_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
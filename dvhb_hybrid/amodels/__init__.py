@@ -1,17 +1,27 @@
+from . import parallel
+from .compact import CompactObject
 from .convert import derive_from_django
 from .decorators import method_connect_once, method_redis_once
-from .model import Model
+from .identity import IdentityMap
+from .lazy import LazyConnection
+from .model import JSON_DELETE, Model
 from .mptt_mixin import MPTTMixin
+from .unit_of_work import UnitOfWork
 from .. import utils
 
 
 __all__ = [
     'AppModels',
+    'CompactObject',
     'Model',
     'derive_from_django',
+    'IdentityMap',
+    'JSON_DELETE',
+    'LazyConnection',
     'method_connect_once',
     'method_redis_once',
     'MPTTMixin',
+    'UnitOfWork',
 ]
 
 
@@ -19,6 +29,8 @@ class AppModels:
     """
     Class to managing all models of application
     """
+    gather_limit = 4  # Connections used at once by gather
+
     def __init__(self, app):
         self.app = app
 
@@ -27,6 +39,32 @@ class AppModels:
             return getattr(self, item)
         return KeyError(item)
 
+    @staticmethod
+    def identity_map():
+        """Returns context manager enabling identity map within the task"""
+        return IdentityMap()
+
+    def unit_of_work(self):
+        """Returns context manager batching writes of the models within the task"""
+        return UnitOfWork(self.app)
+
+    async def gather(self, *reads, connection=None, limit=None):
+        """
+        Runs independent reads on separate connections of the pool.
+        Reads are callables accepting connection,
+        they use passed connection one by one when it is held.
+
+        .. code-block::python
+
+            user, request = await app.m.gather(
+                partial(app.m.user.get_one, user_id),
+                partial(app.m.user_change_email_original_address_request.get_one, code),
+            )
+
+        """
+        return await parallel.gather(
+            self.app, *reads, connection=connection, limit=limit or self.gather_limit)
+
     def __getattr__(self, item):
         if item in Model.models:
             model_cls = Model.models[item]
@@ -0,0 +1,371 @@
+import asyncio
+import datetime
+import json
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.utils import dateparse
+
+from ..aviews import JsonEncoder
+
+
+# Deletes lock only if it is still held by the owner
+_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time,
+    concurrent callers with the same key wait for its result.
+
+    >>> flight = SingleFlight()
+    >>> calls = []
+    >>> async def compute():
+    ...     calls.append(1)
+    ...     await asyncio.sleep(0)
+    ...     return 42
+    >>> async def main():
+    ...     return await asyncio.gather(*[flight.run('k', compute) for _ in range(3)])
+    >>> asyncio.get_event_loop().run_until_complete(main()), len(calls)
+    ([42, 42, 42], 1)
+    """
+
+    def __init__(self):
+        self._futures = {}
+
+    def __len__(self):
+        return len(self._futures)
+
+    def __contains__(self, key):
+        return key in self._futures
+
+    async def run(self, key, compute):
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(compute())
+            self._futures[key] = future
+            future.add_done_callback(lambda f: self._release(key, f))
+        # Computation is not cancelled with one of the callers
+        return await asyncio.shield(future)
+
+    def _release(self, key, future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
+
+
+def _encode_time(value):
+    if value.tzinfo is not None:
+        raise TypeError('Time with time zone is not supported: {!r}'.format(value))
+    return value.isoformat()
+
+
+# Types of values which JSON does not keep: tag, encode, decode
+_ROW_TYPES = (
+    (datetime.datetime, 'datetime', datetime.datetime.isoformat, dateparse.parse_datetime),
+    (datetime.date, 'date', datetime.date.isoformat, dateparse.parse_date),
+    (datetime.time, 'time', _encode_time, dateparse.parse_time),
+    (datetime.timedelta, 'timedelta',
+     lambda v: [v.days, v.seconds, v.microseconds], lambda v: datetime.timedelta(*v)),
+    (Decimal, 'decimal', str, Decimal),
+    (uuid.UUID, 'uuid', str, uuid.UUID),
+)
+_ROW_DECODERS = {tag: decode for _, tag, _, decode in _ROW_TYPES}
+_JSON_TYPES = (str, int, float, list, dict)
+
+
+def _row_type(value):
+    for type_, tag, encode, _ in _ROW_TYPES:
+        if isinstance(value, type_):
+            return tag, encode
+    raise TypeError('Value of type {} is not supported'.format(type(value).__name__))
+
+
+def dumps_rows(rows):
+    """
+    Encodes rows to JSON, names of the columns are stored once.
+    Values of types which JSON does not keep are tagged by column,
+    so values of the column should be of the same type.
+    Raises TypeError for other types.
+
+    >>> rows = [{'id': 1, 'created': datetime.date(2020, 1, 2)}, {'id': 2, 'created': None}]
+    >>> loads_rows(dumps_rows(rows)) == rows
+    True
+    """
+    columns = list(rows[0].keys()) if rows else []
+    tags = [None] * len(columns)
+    # Columns with values which are not None
+    typed = [False] * len(columns)
+    values = []
+    for row in rows:
+        row = list(row.values())
+        for i, v in enumerate(row):
+            if v is None:
+                continue
+            elif isinstance(v, _JSON_TYPES):
+                tag = None
+            else:
+                tag, encode = _row_type(v)
+                row[i] = encode(v)
+            if not typed[i]:
+                tags[i] = tag
+                typed[i] = True
+            elif tags[i] != tag:
+                raise TypeError('Values of column {} are of different types'.format(columns[i]))
+        values.append(row)
+    return JsonEncoder.dumps({'c': columns, 't': tags, 'r': values}).encode()
+
+
+def loads_rows(data):
+    """Returns list of dicts encoded by dumps_rows"""
+    data = json.loads(data.decode() if isinstance(data, bytes) else data)
+    columns = data['c']
+    decoders = [(i, _ROW_DECODERS[tag]) for i, tag in enumerate(data['t']) if tag]
+    result = []
+    for row in data['r']:
+        for i, decode in decoders:
+            if row[i] is not None:
+                row[i] = decode(row[i])
+        result.append(dict(zip(columns, row)))
+    return result
+
+
+def _loads(value, loads):
+    """Returns value, time to compute and time to expire stored in the cache"""
+    if isinstance(value, bytes):
+        value = value.decode()
+    parts = value.split(':')
+    if len(parts) != 3:
+        # Plain value without refresh data
+        return loads(value), None, None
+    value, delta, expires = parts
+    return loads(value), float(delta), float(expires)
+
+
+def _should_refresh(delta, expires, beta):
+    """
+    Probabilistic early expiration: the closer expiration and the longer
+    computation, the more likely caller refreshes the value
+    """
+    if not beta or delta is None:
+        return False
+    return time.time() - delta * beta * math.log(1 - random.random()) >= expires
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU of bytes values with TTL.
+    Size of the cache is limited by number of the values and by their bytes.
+
+    >>> cache = LocalCache(maxsize=2, ttl=60)
+    >>> cache.set('a', b'1'); cache.set('b', b'2'); cache.get('a')
+    b'1'
+    >>> cache.set('c', b'3'); cache.get('b') is None, len(cache), cache.nbytes
+    (True, 2, 2)
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+
+    def __init__(self, maxsize=10000, max_bytes=16 * 1024 * 1024, ttl=2):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Key => (value, time to expire)
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        item = self._values.get(key)
+        if item is not None and item[1] > time.monotonic():
+            self._values.move_to_end(key)
+            self.hits += 1
+            return item[0]
+        elif item is not None:
+            self.discard(key)
+        self.misses += 1
+
+    def set(self, key, value, ttl=None):
+        if isinstance(value, str):
+            value = value.encode()
+        self.discard(key)
+        if len(value) > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._values[key] = value, time.monotonic() + ttl
+        self.nbytes += len(value)
+        while len(self._values) > self.maxsize or self.nbytes > self.max_bytes:
+            _, (old, _) = self._values.popitem(last=False)
+            self.nbytes -= len(old)
+
+    def discard(self, key):
+        item = self._values.pop(key, None)
+        if item is not None:
+            self.nbytes -= len(item[0])
+
+    def clear(self):
+        self._values.clear()
+        self.nbytes = 0
+
+
+class TwoTierCache:
+    """
+    Cache of bytes values in process memory backed by Redis.
+    Value found in Redis is kept in memory for short local TTL,
+    so other processes may see it changed only after that time.
+
+    .. code-block::python
+
+        value = await two_tier.get(redis, key)
+        if value is None:
+            value = compute()
+            await two_tier.set(redis, key, value, expire=60)
+        two_tier.stats()
+
+    """
+
+    def __init__(self, local=None):
+        self.local = local or LocalCache()
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    async def get(self, redis, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = await redis.get(key)
+        if value is None:
+            self.redis_misses += 1
+            return
+        self.redis_hits += 1
+        self.local.set(key, value)
+        return value
+
+    async def set(self, redis, key, value, expire=None):
+        if expire:
+            await redis.set(key, value, expire=expire)
+        else:
+            await redis.set(key, value)
+        self.local.set(key, value, ttl=expire or None)
+
+    def discard(self, key):
+        """Discards the value from memory of the process"""
+        self.local.discard(key)
+
+    def stats(self):
+        """Returns hits and misses per tier"""
+        return {
+            'local': {
+                'hits': self.local.hits,
+                'misses': self.local.misses,
+                'size': len(self.local),
+                'bytes': self.local.nbytes,
+            },
+            'redis': {
+                'hits': self.redis_hits,
+                'misses': self.redis_misses,
+            },
+        }
+
+
+# Cache shared by models and views of the process
+two_tier = TwoTierCache()
+
+
+class RedisCached:
+    """
+    Value cached in Redis, protected against stampede.
+    Only one computation of the key runs in the process
+    and only one process computes the key holding short Redis lock,
+    others wait for the value to appear.
+    Hot value is recomputed by one caller before it expires.
+    Values are read through two-tier cache.
+    """
+    flights = SingleFlight()
+    cache = two_tier
+    lock_timeout = 5000  # Milliseconds to hold the lock
+    lock_poll = 0.05  # Seconds between checks of the value while locked
+    beta = 1.0  # Eagerness of early refresh, 0 to disable
+
+    def __init__(self, redis, key, expire, loads=int):
+        self.redis = redis
+        self.key = key
+        self.expire = expire
+        self.loads = loads
+
+    async def get(self, compute, shared=True):
+        """
+        Returns cached value or stores result of compute.
+        Not shared compute runs in the task of the caller without
+        single flight and the lock, e.g. it uses connection of the caller.
+        """
+        value = await self.cache.get(self.redis, self.key)
+        if value is not None:
+            value, delta, expires = _loads(value, self.loads)
+            if not shared or not _should_refresh(delta, expires, self.beta):
+                return value
+            # Stale value is returned when the other caller refreshes it
+            if self.key in self.flights:
+                return value
+            return await self.flights.run(
+                self.key, lambda: self._refresh(compute, value))
+        elif not shared:
+            return await self._store(compute)
+        return await self.flights.run(self.key, lambda: self._compute(compute))
+
+    async def _lock(self):
+        token = uuid.uuid4().hex
+        locked = await self.redis.set(
+            self.key + ':lock', token,
+            pexpire=self.lock_timeout,
+            exist=self.redis.SET_IF_NOT_EXIST)
+        return token if locked else None
+
+    async def _unlock(self, token):
+        await self.redis.eval(
+            _UNLOCK_SCRIPT, keys=[self.key + ':lock'], args=[token])
+
+    async def _store(self, compute):
+        start = time.time()
+        value = await compute()
+        delta = time.time() - start
+        data = '{}:{}:{}'.format(value, delta, time.time() + self.expire)
+        await self.cache.set(self.redis, self.key, data, expire=self.expire)
+        return value
+
+    async def _refresh(self, compute, value):
+        token = await self._lock()
+        if token is None:
+            return value
+        try:
+            return await self._store(compute)
+        finally:
+            await self._unlock(token)
+
+    async def _compute(self, compute):
+        token = await self._lock()
+        if token is None:
+            # Wait for the value computed by the other process
+            deadline = time.time() + self.lock_timeout / 1000
+            while time.time() < deadline:
+                await asyncio.sleep(self.lock_poll)
+                value = await self.cache.get(self.redis, self.key)
+                if value is not None:
+                    return _loads(value, self.loads)[0]
+            return await compute()
+        try:
+            return await self._store(compute)
+        finally:
+            await self._unlock(token)
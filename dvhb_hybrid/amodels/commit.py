@@ -0,0 +1,57 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Id of connection => connection and callbacks to run after commit
+_callbacks = {}
+
+
+class AfterCommit:
+    """
+    Runs callbacks registered by after_commit for the connection
+    when the block exits without error, so it should wrap the transaction.
+    Blocks nested for the same connection leave callbacks to the outer one.
+
+    .. code-block::python
+
+        async with AfterCommit(connection), connection.transaction():
+            await obj.save(connection=connection)
+
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._callbacks = None
+
+    async def __aenter__(self):
+        key = id(self.connection)
+        if key not in _callbacks:
+            self._callbacks = {}
+            _callbacks[key] = self.connection, self._callbacks
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        callbacks = self._callbacks
+        if callbacks is None:
+            return
+        self._callbacks = None
+        del _callbacks[id(self.connection)]
+        if exc_type is not None:
+            return
+        for callback in callbacks.values():
+            try:
+                await callback()
+            except Exception:
+                logger.exception('Callback after commit failed')
+
+
+def after_commit(connection, key, callback):
+    """
+    Registers coroutine function to call after commit of the transaction
+    wrapped by AfterCommit, the first callback of the key is kept.
+    Returns False when the connection is not within AfterCommit.
+    """
+    pending = _callbacks.get(id(connection))
+    if pending is None or pending[0] is not connection:
+        return False
+    pending[1].setdefault(key, callback)
+    return True
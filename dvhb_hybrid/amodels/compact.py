@@ -0,0 +1,70 @@
+from collections.abc import Mapping
+
+
+class CompactObject(Mapping):
+    """
+    Read-only view of the fetched row.
+    It keeps asyncpg Record without copying it to dict.
+    Model object is created on first write or access to model method
+    and is used since that time.
+
+    >>> class Obj(dict):
+    ...     primary_key = 'id'
+    >>> row = CompactObject(Obj, {'id': 1, 'name': 'a'})
+    >>> row.pk, row.name, row['name'], dict(row)
+    (1, 'a', 'a', {'id': 1, 'name': 'a'})
+    >>> row['name'] = 'b'
+    >>> row.name, row.materialize()
+    ('b', {'id': 1, 'name': 'b'})
+    """
+    __slots__ = ('_model', '_record', '_object')
+
+    def __init__(self, model, record):
+        object.__setattr__(self, '_model', model)
+        object.__setattr__(self, '_record', record)
+        object.__setattr__(self, '_object', None)
+
+    def materialize(self):
+        """Returns model object with data of the row"""
+        obj = self._object
+        if obj is None:
+            obj = self._model(**self._record)
+            object.__setattr__(self, '_object', obj)
+        return obj
+
+    @property
+    def pk(self):
+        return self[self._model.primary_key]
+
+    def __getitem__(self, key):
+        if self._object is not None:
+            return self._object[key]
+        return self._record[key]
+
+    def __iter__(self):
+        if self._object is not None:
+            return iter(self._object)
+        return iter(self._record.keys())
+
+    def __len__(self):
+        if self._object is not None:
+            return len(self._object)
+        return len(self._record)
+
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            return getattr(self.materialize(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self.materialize(), key, value)
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self.materialize()[key]
+
+    def __repr__(self):
+        return '{}({!r})'.format(self._model.__name__, dict(self))
@@ -0,0 +1,322 @@
+import hashlib
+import re
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from asyncpgsa.connection import get_dialect
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import (
+    AsBoolean,
+    BinaryExpression,
+    BindParameter,
+    Cast,
+    ClauseElement,
+    ClauseList,
+    ColumnClause,
+    False_,
+    Grouping,
+    Label,
+    Null,
+    TextClause,
+    True_,
+    TypeClause,
+    UnaryExpression,
+)
+from sqlalchemy.sql.functions import FunctionElement
+
+
+_dialect = get_dialect()
+
+# Marks shape of statement which could not be cached
+_UNCACHEABLE = object()
+
+
+def bind_processor(type_):
+    """
+    Returns function converting python value of the type
+    to database value like compiled statement does, or None
+    """
+    return type_._cached_bind_processor(_dialect)
+
+
+def type_name(type_):
+    """Returns name of the type in the database"""
+    return type_.compile(dialect=_dialect)
+
+
+def base_type_name(type_):
+    """
+    Returns name of the type without arguments
+    or None if the type has no name in the database.
+    Value cast to the type is not truncated unlike cast to VARCHAR(20).
+
+    >>> base_type_name(sa.String(20)), base_type_name(sa.Numeric(10, 2)), base_type_name(sa.types.NullType())
+    ('VARCHAR', 'NUMERIC', None)
+    """
+    try:
+        name = type_name(type_)
+    except Exception:
+        return
+    return re.sub(r'\(.*\)', '', name)
+
+
+def quote(name):
+    """Quotes identifier if it is required"""
+    return _dialect.identifier_preparer.quote(name)
+
+
+def _type_token(type_):
+    """Returns type name with arguments, e.g. NUMERIC(10, 2), or None"""
+    try:
+        return type_name(type_)
+    except Exception:
+        return
+
+
+def _operator_token(operator):
+    """Custom operators are created on each call of op(), so they are described by opstring"""
+    if isinstance(operator, operators.custom_op):
+        return operators.custom_op, operator.opstring, operator.precedence, operator.is_comparison
+    return operator
+
+
+def _token(element):
+    """
+    Returns hashable description of the element without bound values
+    or None if the element is not supported
+    """
+    if isinstance(element, BindParameter):
+        if element.expanding:
+            return
+        return BindParameter, type(element.type)
+    elif isinstance(element, ColumnClause):
+        table = getattr(element.table, 'name', None)
+        return ColumnClause, table, element.name, element.is_literal
+    elif isinstance(element, BinaryExpression):
+        modifiers = tuple(sorted(element.modifiers.items()))
+        return (
+            BinaryExpression, _operator_token(element.operator),
+            _operator_token(element.negate), modifiers)
+    elif isinstance(element, ClauseList):
+        return type(element), _operator_token(element.operator), len(element.clauses)
+    elif isinstance(element, (UnaryExpression, AsBoolean)):
+        return (
+            type(element), _operator_token(element.operator),
+            _operator_token(element.modifier))
+    elif isinstance(element, FunctionElement):
+        return type(element), element.name, tuple(element.packagenames)
+    elif isinstance(element, (Cast, TypeClause)):
+        name = _type_token(element.type)
+        if name is None:
+            return
+        return type(element), name
+    elif isinstance(element, TextClause):
+        return TextClause, element.text
+    elif isinstance(element, Label):
+        return Label, element.name
+    elif isinstance(element, (Grouping, Null, True_, False_)):
+        return type(element),
+
+
+def fingerprint(parts):
+    """
+    Returns shape of the statement parts and list of their bound parameters.
+    Parts are clause elements, strings or None.
+    Returns None when the shape can not be described.
+
+    >>> t = sa.table('t', sa.column('data'), sa.column('price'))
+    >>> def shape(where):
+    ...     return fingerprint([where])[0]
+    >>> shape(t.c.data.op('#>>')('{a}')) == shape(t.c.data.op('#>>')('{b}'))
+    True
+    >>> shape(sa.cast(t.c.price, sa.Numeric(10, 2)) > 1) == shape(sa.cast(t.c.price, sa.Numeric(5, 0)) > 1)
+    False
+    """
+    shape = []
+    binds = []
+    for part in parts:
+        if part is None or isinstance(part, str):
+            shape.append(part)
+            continue
+        elif not isinstance(part, ClauseElement):
+            return
+        for element in visitors.iterate(part, {}):
+            token = _token(element)
+            if token is None:
+                return
+            elif token[0] is BindParameter:
+                binds.append(element)
+            shape.append(token)
+    return tuple(shape), binds
+
+
+def _stable(value):
+    """
+    Returns representation of the shape token
+    which is the same in all the processes
+    """
+    if isinstance(value, tuple):
+        return '({})'.format(','.join(_stable(i) for i in value))
+    elif isinstance(value, operators.custom_op):
+        return 'op:{}'.format(value.opstring)
+    elif isinstance(value, type) or callable(value):
+        return '{}.{}'.format(value.__module__, value.__qualname__)
+    return repr(value)
+
+
+def _digest(data=b''):
+    return hashlib.blake2b(data, digest_size=16)
+
+
+# Digests of the shapes, the shape is much cheaper to hash than to represent
+_shape_digests = OrderedDict()
+_SHAPE_DIGESTS_SIZE = 1024
+
+
+def statement_key(parts):
+    """
+    Returns 128-bit hex digest of shape and bound values of the statement parts
+    without compiling the statement or None if the shape is not supported.
+
+    >>> t = sa.table('t', sa.column('id', sa.Integer))
+    >>> statement_key(['t', t.c.id == 1]) == statement_key(['t', t.c.id == 1])
+    True
+    >>> statement_key(['t', t.c.id == 1]) == statement_key(['t', t.c.id == '1'])
+    False
+    >>> key = statement_key(['t', sa.cast(t.c.id, sa.String(3)) == '1'])
+    >>> key == statement_key(['t', sa.cast(t.c.id, sa.String(10)) == '1'])
+    False
+    """
+    shape = fingerprint(parts)
+    if shape is None:
+        return
+    shape, binds = shape
+    shape_digest = _shape_digests.get(shape)
+    if shape_digest is None:
+        shape_digest = _digest(_stable(shape).encode()).digest()
+        _shape_digests[shape] = shape_digest
+        if len(_shape_digests) > _SHAPE_DIGESTS_SIZE:
+            _shape_digests.popitem(last=False)
+    else:
+        _shape_digests.move_to_end(shape)
+    result = _digest(shape_digest)
+    for bind in binds:
+        result.update(repr(bind.effective_value).encode())
+        result.update(b'\0')
+    return result.hexdigest()
+
+
+def hash_statement(statement):
+    """Returns 128-bit hex digest of compiled statement and its parameters"""
+    compiled = statement.compile()
+    msg = compiled.string + repr(compiled.params)
+    return _digest(msg.encode()).hexdigest()
+
+
+class CompiledStatement:
+    """
+    SQL text of the statement and the rules to extract its arguments
+    """
+    __slots__ = ('sql', 'slots')
+
+    def __init__(self, sql, slots):
+        self.sql = sql
+        # Pairs of (index of bound parameter or name of extra value, processor)
+        self.slots = slots
+
+    @classmethod
+    def compile(cls, statement, binds):
+        """
+        Compiles statement like asyncpgsa does.
+        Returns None if some parameter is not found in binds.
+        """
+        compiled = statement.compile(dialect=_dialect)
+        processors = compiled._bind_processors
+        indexes = {id(b): i for i, b in enumerate(binds)}
+        mapping = {}
+        slots = []
+        for n, name in enumerate(sorted(compiled.params), start=1):
+            bind = compiled.binds[name]
+            if id(bind) in indexes:
+                source = indexes[id(bind)]
+            elif bind.key in ('offset', 'limit'):
+                source = bind.key
+            else:
+                return
+            mapping[name] = '${}'.format(n)
+            slots.append((source, processors.get(name)))
+        return cls(compiled.string % mapping, tuple(slots))
+
+    def arguments(self, binds, **extra):
+        result = []
+        for source, processor in self.slots:
+            if isinstance(source, int):
+                value = binds[source].effective_value
+            else:
+                value = extra[source]
+            if processor is not None:
+                value = processor(value)
+            result.append(value)
+        return result
+
+
+class StatementCache:
+    """
+    Cache of compiled statements keyed by shape of the statement.
+    Statement with the same shape is compiled once and then executed as SQL text
+    with positional arguments so asyncpg can reuse prepared statement.
+
+    >>> cache = StatementCache(maxsize=2)
+    >>> t = sa.table('t', sa.column('id', sa.Integer))
+    >>> def build(where, offset=None, limit=None):
+    ...     return sa.select([t.c.id]).where(where).limit(limit)
+    >>> where = t.c.id == 1
+    >>> cache.prepare(lambda **kw: build(where, **kw), [where], limit=10)
+    ('SELECT t.id \\nFROM t \\nWHERE t.id = $1 \\n LIMIT $2', [1, 10])
+    >>> where = t.c.id == 2
+    >>> cache.prepare(lambda **kw: build(where, **kw), [where], limit=5)
+    ('SELECT t.id \\nFROM t \\nWHERE t.id = $1 \\n LIMIT $2', [2, 5])
+    >>> len(cache)
+    1
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._statements = OrderedDict()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def clear(self):
+        self._statements.clear()
+
+    def prepare(self, build, parts, offset=None, limit=None):
+        """
+        Returns query and list of its arguments.
+
+        :param build: callable which takes offset and limit and returns statement
+        :param parts: all the clauses and strings passed to build the statement
+        :param offset: value of OFFSET if any
+        :param limit: value of LIMIT if any
+        """
+        shape = fingerprint(parts)
+        if shape is None:
+            return build(offset=offset, limit=limit), ()
+        shape, binds = shape
+        key = shape, offset is not None, limit is not None
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = CompiledStatement.compile(build(
+                offset=None if offset is None else sa.bindparam('offset', type_=sa.Integer),
+                limit=None if limit is None else sa.bindparam('limit', type_=sa.Integer),
+            ), binds)
+            if statement is None:
+                statement = _UNCACHEABLE
+            self._statements[key] = statement
+            if len(self._statements) > self.maxsize:
+                self._statements.popitem(last=False)
+        else:
+            self._statements.move_to_end(key)
+        if statement is _UNCACHEABLE:
+            return build(offset=offset, limit=limit), ()
+        return statement.sql, statement.arguments(binds, offset=offset, limit=limit)
@@ -70,7 +70,7 @@ class FieldConverter:
             kwargs['geometry_type'] = 'POINT'
             kwargs['srid'] = dj_field.srid
         elif sa_type is sa_types.Numeric:
-            kwargs['scale'] = dj_field.decimal_places,
+            kwargs['scale'] = dj_field.decimal_places
             kwargs['precision'] = dj_field.max_digits
         elif sa_type in (sa_types.String, sa_types.Text):
             kwargs['length'] = dj_field.max_length
@@ -97,7 +97,10 @@ class FieldConverter:
                 internal_type,
                 dj_field
             )
-        return sa.column(*result)
+        column = sa.column(*result)
+        # Column clause has no nullable flag, it is used to compare rows of pages
+        column.nullable = dj_field.null
+        return column
 
 
 FIELD_CONVERTER = FieldConverter()
@@ -134,6 +137,7 @@ def derive_from_django(dj_model, **field_types):
         for k, v in rels.items():
             setattr(amodel, k, v)
         amodel.primary_key = dj_model._meta.pk.attname
+        amodel.bind_columns()
         return amodel
     return wrapper
 
@@ -24,6 +24,7 @@ class ConnectionLogger:
             return await asyncio.wait_for(coro, timeout=10)
         except Exception as e:
             q, p = compile_query(query)
+            p = p or multiparams
             self._logger.critical('SQL ERROR %s:\n%s\n%s', e, q, p)
             raise
 
@@ -1,8 +1,10 @@
 import asyncio
 import functools
+import inspect
 from weakref import WeakKeyDictionary
 
 from .debug import ConnectionLogger
+from .lazy import LazyConnection
 from ..utils import get_app_from_parameters
 
 
@@ -25,14 +27,72 @@ class Guard:
             del self._d[self._task]
 
 
-def method_connect_once(arg):
+def _get_pool(app, read, use_primary):
+    router = app.get('db_router')
+    if router is None:
+        return app['db']
+    return router.pool(read=read, use_primary=use_primary)
+
+
+def _get_lazy_connection(app, read, use_primary):
+    """Returns lazy connection of the task if the method should use it"""
+    connection = LazyConnection.current()
+    if connection is None or connection.app is not app:
+        return
+    router = app.get('db_router')
+    if router is not None:
+        # Reads keep going to replicas
+        if read and not (use_primary or router.has_written()):
+            return
+    return connection
+
+
+def _connect_once_generator(func, read):
+    # Guard is not used because caller code runs between iterations
+    # and may acquire another connection
+    @functools.wraps(func)
+    async def wrapper(*args, use_primary=False, **kwargs):
+        if kwargs.get('connection') is None:
+            app = get_app_from_parameters(*args, **kwargs)
+            connection = _get_lazy_connection(app, read, use_primary)
+            if connection is not None:
+                kwargs['connection'] = connection
+                async for i in func(*args, **kwargs):
+                    yield i
+                return
+            pool = _get_pool(app, read, use_primary)
+            async with pool.acquire() as connection:
+                kwargs['connection'] = ConnectionLogger(connection)
+                async for i in func(*args, **kwargs):
+                    yield i
+        else:
+            async for i in func(*args, **kwargs):
+                yield i
+    return wrapper
+
+
+def method_connect_once(arg=None, *, read=False):
+    """
+    Acquires connection if it is not passed.
+    Methods with read acquire it from replica when application has them
+    unless use_primary is passed.
+    Lazy connection of the task is used instead of acquiring when it is set.
+    """
     def with_arg(func):
+        if inspect.isasyncgenfunction(func):
+            return _connect_once_generator(func, read)
+
         @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
+        async def wrapper(*args, use_primary=False, **kwargs):
             if kwargs.get('connection') is None:
                 app = get_app_from_parameters(*args, **kwargs)
+                connection = _get_lazy_connection(app, read, use_primary)
+                if connection is not None:
+                    kwargs['connection'] = connection
+                    return await func(*args, **kwargs)
+                pool = _get_pool(app, read, use_primary)
                 with Guard('pg', app.loop):
-                    async with app['db'].acquire() as connection:
+                    async with pool.acquire() as connection:
                         kwargs['connection'] = ConnectionLogger(connection)
                         return await func(*args, **kwargs)
             else:
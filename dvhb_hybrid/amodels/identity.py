@@ -0,0 +1,86 @@
+import asyncio
+from weakref import WeakKeyDictionary
+
+
+def _current_task():
+    current_task = getattr(asyncio, 'current_task', None)
+    if current_task is None:
+        current_task = asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:
+        # No running loop
+        return
+
+
+class IdentityMap:
+    """
+    Rows loaded by primary key within the task, usually within request.
+    Model.get_one and Model.get_dict consult it before the database,
+    writes through the model discard affected rows.
+
+    .. code-block::python
+
+        with IdentityMap():
+            user = await app.m.user.get_one(user_id)
+            # Does not reach database
+            user = await app.m.user.get_one(user_id)
+
+    """
+    maps = WeakKeyDictionary()
+
+    def __init__(self):
+        self._rows = {}
+        self._task = None
+        self._previous = None
+
+    @classmethod
+    def current(cls):
+        """Returns identity map of the current task or None"""
+        task = _current_task()
+        if task is not None:
+            return cls.maps.get(task)
+
+    def __enter__(self):
+        self._task = _current_task()
+        if self._task is None:
+            raise RuntimeError('IdentityMap should be used within task')
+        self._previous = self.maps.get(self._task)
+        self.maps[self._task] = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._previous is None:
+            del self.maps[self._task]
+        else:
+            self.maps[self._task] = self._previous
+        self._task = self._previous = None
+        self.clear()
+
+    def get(self, table, pk, fields):
+        """Returns dict of the fields of the row or None if some field is not loaded"""
+        row = self._rows.get((table, pk))
+        if row is None:
+            return
+        try:
+            return {k: row[k] for k in fields}
+        except KeyError:
+            return
+
+    def add(self, table, pk, data):
+        row = self._rows.setdefault((table, pk), {})
+        row.update(data)
+
+    def discard(self, table, pk=None):
+        """Discards the row or all the rows of the table if pk is None"""
+        if pk is not None:
+            self._rows.pop((table, pk), None)
+            return
+        for key in [k for k in self._rows if k[0] == table]:
+            del self._rows[key]
+
+    def clear(self):
+        self._rows.clear()
+
+    def __len__(self):
+        return len(self._rows)
@@ -0,0 +1,173 @@
+import asyncio
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from .commit import AfterCommit
+from .debug import ConnectionLogger
+from .identity import _current_task
+
+# Methods acquiring the connection on call
+LAZY_METHODS = (
+    'fetch', 'fetchrow', 'fetchval', 'execute', 'executemany',
+    'copy_records_to_table',
+)
+
+
+class LazyConnection:
+    """
+    Connection of the task, usually of the request, acquired from the pool
+    only on the first query. Models decorated by method_connect_once
+    use it instead of acquiring own connection.
+    It is released on exit or after idle seconds without queries,
+    the next query acquires connection again.
+
+    .. code-block::python
+
+        async with LazyConnection(app, idle=1):
+            # Does not hold connection while Redis answers
+            user = await app.m.user.get_one(user_id, cache=60)
+
+    """
+    connections = WeakKeyDictionary()
+
+    def __init__(self, app, idle=None, app_key='db'):
+        self.app = app
+        self.idle = idle
+        self._app_key = app_key
+        self._connection = None
+        self._raw = None
+        # Running queries and transactions which prevent release
+        self._busy = 0
+        self._handle = None
+        self._task = None
+        self._previous = None
+
+    @classmethod
+    def current(cls):
+        """Returns lazy connection of the current task or None"""
+        task = _current_task()
+        if task is not None:
+            return cls.connections.get(task)
+
+    @property
+    def acquired(self):
+        return self._raw is not None
+
+    async def __aenter__(self):
+        self._task = _current_task()
+        if self._task is None:
+            raise RuntimeError('LazyConnection should be used within task')
+        self._previous = self.connections.get(self._task)
+        self.connections[self._task] = self
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._previous is None:
+            del self.connections[self._task]
+        else:
+            self.connections[self._task] = self._previous
+        self._task = self._previous = None
+        await self.release()
+
+    async def acquire(self):
+        """Returns connection acquiring it from the pool if it is not acquired"""
+        self._cancel_idle()
+        if self._raw is None:
+            self._raw = await self.app[self._app_key].acquire()
+            self._connection = ConnectionLogger(self._raw)
+        return self._connection
+
+    async def release(self):
+        """Returns connection to the pool"""
+        self._cancel_idle()
+        raw = self._detach()
+        if raw is not None:
+            await self.app[self._app_key].release(raw)
+
+    def _detach(self):
+        raw = self._raw
+        self._raw = self._connection = None
+        return raw
+
+    def _cancel_idle(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule_idle(self):
+        if self.idle is None or self._busy or self._raw is None:
+            return
+        self._cancel_idle()
+        loop = asyncio.get_event_loop()
+        self._handle = loop.call_later(self.idle, self._on_idle)
+
+    def _on_idle(self):
+        self._handle = None
+        if self._busy:
+            return
+        # Connection is detached at once, so the next query acquires new one
+        raw = self._detach()
+        if raw is not None:
+            asyncio.ensure_future(self.app[self._app_key].release(raw))
+
+    async def _call(self, method, *args, **kwargs):
+        self._busy += 1
+        try:
+            connection = await self.acquire()
+            return await getattr(connection, method)(*args, **kwargs)
+        finally:
+            self._busy -= 1
+            self._schedule_idle()
+
+    def is_in_transaction(self):
+        return self._connection is not None and self._connection.is_in_transaction()
+
+    def transaction(self, **kwargs):
+        """Returns transaction which holds the connection till its end"""
+        return _LazyTransaction(self, kwargs)
+
+    def __getattr__(self, item):
+        if item in LAZY_METHODS:
+            return partial(self._call, item)
+        if item.startswith('_'):
+            raise AttributeError(item)
+        if self._connection is None:
+            raise RuntimeError(
+                'Connection is not acquired to get {!r}, use it within transaction'.format(item))
+        return getattr(self._connection, item)
+
+
+class _LazyTransaction:
+    def __init__(self, connection, kwargs):
+        self._connection = connection
+        self._kwargs = kwargs
+        self._transaction = None
+        # Generations of models written within it are bumped after commit
+        self._after_commit = AfterCommit(connection)
+
+    async def __aenter__(self):
+        self._connection._busy += 1
+        await self._after_commit.__aenter__()
+        try:
+            connection = await self._connection.acquire()
+            self._transaction = connection.transaction(**self._kwargs)
+            return await self._transaction.__aenter__()
+        except BaseException as e:
+            self._done()
+            await self._after_commit.__aexit__(type(e), e, e.__traceback__)
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            result = await self._transaction.__aexit__(exc_type, exc_val, exc_tb)
+        except BaseException as e:
+            self._done()
+            await self._after_commit.__aexit__(type(e), e, e.__traceback__)
+            raise
+        self._done()
+        await self._after_commit.__aexit__(exc_type, exc_val, exc_tb)
+        return result
+
+    def _done(self):
+        self._connection._busy -= 1
+        self._connection._schedule_idle()
@@ -0,0 +1,70 @@
+import asyncio
+
+
+class BatchLoader:
+    """
+    Collects primary key lookups of the model made at the same time
+    and fetches them by single query on one pooled connection.
+
+    :param model: model bound to application
+    :param window: seconds to collect lookups, 0 means current loop iteration
+    :param max_size: max primary keys in one query
+    """
+
+    def __init__(self, model, *, window=0, max_size=100):
+        self.model = model
+        self.window = window
+        self.max_size = max_size
+        # fields => {primary key => [futures]}
+        self._batches = {}
+        self._handle = None
+
+    def load(self, pk, fields=None):
+        """
+        Returns future of the object or None if it is not found
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        batch = self._batches.setdefault(fields, {})
+        batch.setdefault(pk, []).append(future)
+        if len(batch) >= self.max_size:
+            self._dispatch_batch(fields)
+        elif self._handle is None:
+            if self.window:
+                self._handle = loop.call_later(self.window, self._dispatch)
+            else:
+                self._handle = loop.call_soon(self._dispatch)
+        return future
+
+    def _dispatch(self):
+        self._handle = None
+        for fields in list(self._batches):
+            self._dispatch_batch(fields)
+
+    def _dispatch_batch(self, fields):
+        batch = self._batches.pop(fields)
+        asyncio.ensure_future(self._fetch(fields, batch))
+
+    async def _fetch(self, fields, batch):
+        model = self.model
+        if fields is not None and model.primary_key not in fields:
+            fields = fields + (model.primary_key,)
+        try:
+            # Loaded objects are copied for each caller, so they are not compact nor cached
+            objects = await model.get_list(
+                model._any(model.primary_key, batch), fields=fields, compact=False, cache=0)
+        except Exception as e:
+            for futures in batch.values():
+                for f in futures:
+                    if not f.done():
+                        f.set_exception(e)
+            return
+        objects = {i.pk: i for i in objects}
+        for pk, futures in batch.items():
+            obj = objects.get(pk)
+            for f in futures:
+                if not f.done():
+                    f.set_result(obj)
+                    # Each caller gets own object
+                    if obj is not None:
+                        obj = model(obj)
@@ -1,15 +1,18 @@
 import itertools
 import json
+import logging
 import uuid
 
 from abc import ABCMeta
-from functools import reduce
+from functools import partial, reduce
 from operator import and_
 
 import sqlalchemy as sa
 
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.sql.elements import ClauseElement
+from django.core import signing
+from asyncpgsa.connection import compile_query
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.sql.elements import ClauseElement, ColumnClause
 from sqlalchemy import func
 
 try:
@@ -18,12 +21,76 @@ except ImportError:
     dtrans = None
 
 
+from .cache import RedisCached, dumps_rows, loads_rows
+from .commit import AfterCommit, after_commit
+from .compact import CompactObject
+from .compiled import (
+    StatementCache,
+    base_type_name,
+    bind_processor,
+    hash_statement,
+    quote,
+    statement_key,
+)
 from .decorators import method_connect_once, method_redis_once
+from .identity import IdentityMap
+from .loader import BatchLoader
+from .parallel import _holds_connection
+from .unit_of_work import deferred, immediate
 from .. import utils, exceptions, aviews
 
 
 CACHE_CATEGORY_COUNT = 'count'
 CACHE_CATEGORY_SUM = 'aggregate:sum'
+CACHE_CATEGORY_GENERATION = 'generation'
+CACHE_CATEGORY_ROWS = 'rows'
+# TTL of the result cache when it is enabled without model cache_ttl
+CACHE_TTL_DEFAULT = 60
+
+# Label of the flag returned by upsert queries
+COLUMN_CREATED = '_created'
+# Max number of parameters of the statement in PostgreSQL
+MAX_PARAMETERS = 32767
+# Column to keep order of rows copied into temporary table
+COLUMN_COPY_ORDER = '_copy_order'
+
+logger = logging.getLogger(__name__)
+
+# SET of JSONB column merged by update_many(merge=True)
+_MERGE_JSON = "{0} = COALESCE({1}.{0}, '{{}}'::jsonb) || _v.{0}::jsonb"
+
+
+class _JsonDelete:
+    def __repr__(self):
+        return 'JSON_DELETE'
+
+
+# Value of the path to delete by update_json_paths
+JSON_DELETE = _JsonDelete()
+
+
+def _json_path(path):
+    return sa.cast(sa.bindparam(None, list(path), type_=sa.ARRAY(sa.Text)), sa.ARRAY(sa.Text))
+
+
+class ColumnDescriptor:
+    """
+    Attribute of the model object for the column,
+    it is found by type lookup without fallback to __getattr__.
+    Assignment is done by Model.__setattr__ which sets the field.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return instance[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
 
 
 class MetaModel(ABCMeta):
@@ -31,8 +98,19 @@ class MetaModel(ABCMeta):
         cls = ABCMeta.__new__(mcls, name, bases, namespace)
         name = utils.convert_class_name(name)
         cls.models[name] = cls
+        if namespace.get('table') is not None:
+            cls.bind_columns()
         return cls
 
+    def bind_columns(cls):
+        """
+        Adds descriptors of the columns of the table.
+        Names of methods and other attributes of the model are kept.
+        """
+        for name in cls.table.c.keys():
+            if name.isidentifier() and not hasattr(cls, name):
+                setattr(cls, name, ColumnDescriptor(name))
+
 
 class Model(dict, metaclass=MetaModel):
     models = {}
@@ -45,22 +123,78 @@ class Model(dict, metaclass=MetaModel):
     fields_list = ()
     fields_one = None
     fields_localized = None
+    statement_cache_size = 256  # Compiled statements per model, 0 to disable
+    use_upsert = False  # Save and get_or_create by single INSERT ... ON CONFLICT
+    copy_chunk_size = 10000  # Objects per COPY in create_many(copy=True)
+    iter_prefetch = 1000  # Rows fetched from cursor at once in iter_list
+    compact_rows = False  # Lists contain CompactObject instead of model objects
+    batch_get_one = False  # Concurrent get_one by primary key share one query
+    loader_window = 0  # Seconds to collect get_one calls, 0 means one loop iteration
+    loader_max_size = 100  # Primary keys in one query of the loader
+    bulk_chunk_size = 1000  # Objects per statement in update_many and upsert_many
+    cache_ttl = 0  # Seconds to cache results of get_one, get_list and get_dict
 
     @classmethod
     def factory(cls, app):
         return type(cls.__name__, (cls,), {'app': app})
 
     @classmethod
-    def get_cache_key(cls, *args):
+    def get_cache_key(cls, *args, generation=None):
         parts = []
         if hasattr(cls.app, 'name'):
             parts.append(cls.app.name)
         else:
             parts.append(cls.app.__class__.__module__)
         parts.append(cls.__name__)
+        if generation is not None:
+            parts.append('g{}'.format(generation))
         parts.extend(args)
         return ':'.join(parts)
 
+    @classmethod
+    @method_redis_once
+    async def get_generation(cls, redis=None):
+        """
+        Returns generation of the model data, it is changed by every write.
+        It is read from Redis on every call, so writes of other processes
+        are seen at once, only values cached under it are kept in memory.
+        """
+        generation = await redis.get(cls.get_cache_key(CACHE_CATEGORY_GENERATION))
+        return int(generation or 0)
+
+    @classmethod
+    async def invalidate_cache(cls, redis=None, connection=None):
+        """
+        Bumps generation of the model so aggregates cached before are not used.
+        It is called by writes of the model with their connection.
+        Concurrent readers may cache data which does not contain writes
+        of the transaction under the new generation, so it is bumped again
+        after commit of the transaction wrapped by AfterCommit: transactions
+        of delete, unit of work and lazy connection are. Callers owning
+        other transactions should call it after commit.
+        Failures of Redis are logged, the written data is not affected.
+        Reads of the task go to primary after it to see the writes.
+        """
+        router = cls.app.get('db_router')
+        if router is not None:
+            router.written()
+        if redis is None:
+            redis = cls.app.get('redis')
+            if redis is None:
+                return
+        await cls._bump_generation(redis)
+        if connection is not None:
+            after_commit(
+                connection, (CACHE_CATEGORY_GENERATION, cls),
+                partial(cls._bump_generation, redis))
+
+    @classmethod
+    async def _bump_generation(cls, redis):
+        try:
+            await redis.incr(cls.get_cache_key(CACHE_CATEGORY_GENERATION))
+        except Exception:
+            logger.exception('Generation of %s is not bumped', cls.__name__)
+
     def copy_object(self):
         cls = type(self)
         obj = cls(
@@ -124,38 +258,282 @@ class Model(dict, metaclass=MetaModel):
         pass
 
     @classmethod
-    async def _get_one(cls, *args, connection=None, fields=None, **kwargs):
+    def get_statement_cache(cls):
+        """Returns cache of compiled statements of the model"""
+        cache = cls.__dict__.get('_statement_cache')
+        if cache is None and cls.statement_cache_size:
+            cache = StatementCache(maxsize=cls.statement_cache_size)
+            cls._statement_cache = cache
+        return cache
+
+    @classmethod
+    def _select(cls, fields=None, where=None, sort=None, offset=None, limit=None, select_from=None):
+        if fields:
+            sql = sa.select(fields).select_from(cls.table)
+        else:
+            sql = cls.table.select()
+
+        for i in select_from or ():
+            sql = sql.select_from(i)
+
+        if where is not None:
+            sql = sql.where(where)
+
+        if offset is not None:
+            sql = sql.offset(offset)
+
+        if limit is not None:
+            sql = sql.limit(limit)
+
+        if isinstance(sort, str):
+            sql = sql.order_by(sort)
+        elif sort:
+            sql = sql.order_by(*sort)
+
+        return sql
+
+    @classmethod
+    def _select_parts(cls, fields=None, where=None, sort=None):
+        """Returns parts of the select to fingerprint it"""
+        parts = [cls.table.name, where]
+        parts.extend(fields or ())
+        if isinstance(sort, str) or not sort:
+            parts.append(sort)
+        else:
+            parts.extend(sort)
+        return parts
+
+    @classmethod
+    def _prepare_select(cls, fields=None, where=None, sort=None, offset=None, limit=None, select_from=None):
+        """
+        Returns query and arguments to fetch.
+        Statements of the same shape are compiled once.
+        """
+        cache = cls.get_statement_cache()
+        if cache is None or select_from:
+            sql = cls._select(
+                fields=fields, where=where, sort=sort,
+                offset=offset, limit=limit, select_from=select_from)
+            return sql, ()
+
+        parts = cls._select_parts(fields=fields, where=where, sort=sort)
+
+        def build(offset, limit):
+            return cls._select(fields=fields, where=where, sort=sort, offset=offset, limit=limit)
+
+        return cache.prepare(build, parts, offset=offset, limit=limit)
+
+    @classmethod
+    def _one_select(cls, args, kwargs, fields=None, locale=None):
+        """Returns columns and where clause of get_one"""
         if args or kwargs:
-            args = cls._where(args, kwargs)
+            where, = cls._where(args, kwargs)
+            if where is None:
+                # Nothing to find by empty key
+                where = sa.null()
+        else:
+            where = None
 
         if fields:
             fields = cls.to_column(fields)
         elif cls.fields_one:
             fields = cls.to_column(cls.fields_one)
+        return cls._localized_columns(fields, locale), where
 
-        if fields:
-            sql = sa.select(fields).select_from(cls.table)
-        else:
-            sql = cls.table.select()
+    @classmethod
+    async def _get_one(cls, *args, connection=None, fields=None, locale=None, **kwargs):
+        fields, where = cls._one_select(args, kwargs, fields, locale)
+        sql, params = cls._prepare_select(fields=fields, where=where)
+        return await connection.fetchrow(sql, *params)
 
-        if args:
-            sql = sql.where(*args)
+    @classmethod
+    @method_connect_once(read=True)
+    async def _fetch(cls, sql, params=(), *, one=False, connection=None):
+        if one:
+            row = await connection.fetchrow(sql, *params)
+            return [row] if row else []
+        return await connection.fetch(sql, *params)
 
-        return await connection.fetchrow(sql)
+    @classmethod
+    def _cache_ttl(cls, cache=None):
+        """Returns seconds to cache result of the query or 0"""
+        if cache is None:
+            return cls.cache_ttl
+        elif cache is True:
+            return cls.cache_ttl or CACHE_TTL_DEFAULT
+        return cache or 0
 
     @classmethod
-    @method_connect_once
-    async def get_one(cls, *args, connection=None, fields=None, silent=False, **kwargs):
+    @method_redis_once
+    async def _cached_rows(cls, parts, fetch, expire, redis=None):
         """
-        Extract by id
+        Returns rows of the query from the cache
+        or fetches and caches them for expire seconds.
+        Cached rows are discarded by any write of the model.
         """
-        r = await cls._get_one(*args, connection=connection, fields=fields, **kwargs)
+        postfix = statement_key(parts)
+        if postfix is None:
+            return await fetch()
+        generation = await cls.get_generation(redis=redis)
+        key = cls.get_cache_key(CACHE_CATEGORY_ROWS, postfix, generation=generation)
+        data = await redis.get(key)
+        if data is not None:
+            return loads_rows(data)
+        rows = await fetch()
+        try:
+            data = dumps_rows(rows)
+        except TypeError:
+            # Rows with values which can not be encoded are not cached
+            return rows
+        await redis.set(key, data, expire=expire)
+        return rows
+
+    @classmethod
+    def _field_names(cls, fields, default=None):
+        """Returns names of the fields to be selected or None for expressions"""
+        fields = fields or default
+        if not fields:
+            return cls.table.c.keys()
+        result = []
+        for f in fields:
+            if not isinstance(f, str):
+                if not isinstance(f, ColumnClause) or f.table is not cls.table:
+                    return
+                f = f.key
+            result.append(f)
+        return result
+
+    @classmethod
+    def _pk_python_type(cls):
+        try:
+            return cls.table.c[cls.primary_key].type.python_type
+        except NotImplementedError:
+            return
+
+    @classmethod
+    def _identity_pk(cls, pk):
+        """Returns primary key as it is kept in identity map, e.g. 5 for '5'"""
+        if isinstance(pk, str):
+            python_type = cls._pk_python_type()
+            if python_type is not None and python_type is not str:
+                try:
+                    return python_type(pk)
+                except (TypeError, ValueError):
+                    pass
+        return pk
+
+    @classmethod
+    def _discard_identity(cls, pk=None):
+        """Discards the row or all the rows of the model from identity map"""
+        identity_map = IdentityMap.current()
+        if identity_map is not None:
+            identity_map.discard(cls.table.name, pk)
+
+    @classmethod
+    def _any(cls, field, values):
+        """Returns clause field = ANY(values) with values as single array parameter"""
+        column = cls.table.c[field]
+        values = sa.bindparam(None, list(values), type_=sa.ARRAY(column.type))
+        return column == sa.any_(values)
+
+    @classmethod
+    def get_loader(cls):
+        """Returns loader collecting concurrent get_one by primary key"""
+        loader = cls.__dict__.get('_loader')
+        if loader is None:
+            loader = BatchLoader(
+                cls, window=cls.loader_window, max_size=cls.loader_max_size)
+            cls._loader = loader
+        return loader
+
+    @classmethod
+    def _has_written(cls):
+        """Returns True if the current task should read from primary after write"""
+        router = cls.app.get('db_router')
+        return router is not None and router.has_written()
+
+    @classmethod
+    async def get_one(cls, *args, connection=None, fields=None, silent=False,
+                      use_primary=False, cache=None, locale=None, **kwargs):
+        """
+        Extract by id.
+        With batch_get_one lookups by primary key without connection
+        made at the same time are fetched by single query.
+        With cache (seconds or True for cache_ttl of the model)
+        the result is cached in Redis until the model is written.
+        With locale localized fields are selected in the language.
+        """
+        identity_map = IdentityMap.current()
+        # Localized rows are not kept in identity map
+        if identity_map is not None and not locale and cls._is_pk_lookup(args, kwargs):
+            names = cls._field_names(fields, cls.fields_one)
+            if names is not None:
+                pk = cls._identity_pk(args[0] if args else next(iter(kwargs.values())))
+                data = identity_map.get(cls.table.name, pk, names)
+                if data is not None:
+                    return cls(**data)
+        expire = cls._cache_ttl(cache)
+        if expire and connection is None and not use_primary:
+            columns, where = cls._one_select(args, kwargs, fields, locale)
+            # Statement is prepared only when the rows are not cached
+            rows = await cls._cached_rows(
+                ['one'] + cls._select_parts(fields=columns, where=where),
+                lambda: cls._fetch(*cls._prepare_select(fields=columns, where=where), one=True),
+                expire)
+            if rows:
+                return cls(**rows[0])
+            elif not silent:
+                raise exceptions.NotFound()
+            return
+        # Loader fetches on own connection which does not see transaction of the caller
+        if cls.batch_get_one and not _holds_connection(connection) and not use_primary and not locale \
+                and cls._is_pk_lookup(args, kwargs) and not cls._has_written():
+            pk = args[0] if args else next(iter(kwargs.values()))
+            names = cls._field_names(fields, cls.fields_one)
+            python_type = cls._pk_python_type()
+            # Loader matches fetched rows by the value of primary key
+            if names is not None and python_type and isinstance(pk, python_type):
+                return await cls.load_one(pk, fields=names, silent=silent)
+        return await cls._get_one_connected(
+            *args, connection=connection, fields=fields, silent=silent,
+            use_primary=use_primary, locale=locale, **kwargs)
+
+    @classmethod
+    async def load_one(cls, pk, *, fields=None, silent=False):
+        """
+        Extract by primary key using loader.
+        Fields are names of columns.
+        """
+        names = tuple(cls._field_names(fields, cls.fields_one))
+        identity_map = IdentityMap.current()
+        if identity_map is not None:
+            data = identity_map.get(cls.table.name, pk, names)
+            if data is not None:
+                return cls(**data)
+        obj = await cls.get_loader().load(pk, names)
+        if obj is not None:
+            if identity_map is not None:
+                identity_map.add(cls.table.name, pk, obj)
+            return obj
+        elif not silent:
+            raise exceptions.NotFound()
+
+    @classmethod
+    @method_connect_once(read=True)
+    async def _get_one_connected(cls, *args, connection=None, fields=None, silent=False,
+                                 locale=None, **kwargs):
+        r = await cls._get_one(*args, connection=connection, fields=fields, locale=locale, **kwargs)
         if r:
+            identity_map = IdentityMap.current()
+            if identity_map is not None and not locale and cls._is_pk_lookup(args, kwargs) \
+                    and cls.primary_key in r and cls._field_names(fields, cls.fields_one) is not None:
+                # Row is kept by the fetched key, so '5' and 5 find the same row
+                identity_map.add(cls.table.name, r[cls.primary_key], r)
             return cls(**r)
         elif not silent:
             raise exceptions.NotFound()
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def load_fields(self, *fields, connection, force_update=False):
         fields = set(fields)
         if force_update is False:
@@ -171,50 +549,333 @@ class Model(dict, metaclass=MetaModel):
             dict.update(self, r)
 
     @classmethod
-    @method_connect_once
-    async def get_list(cls, *args, connection, fields=None,
-                       offset=None, limit=None, sort=None,
-                       select_from=None):
-        """Extract list"""
+    @method_connect_once(read=True)
+    async def load_fields_many(cls, objects, *fields, connection=None, force_update=False):
+        """
+        Loads fields missing in the objects by one query and updates them in place.
+        With force_update the fields are reloaded,
+        it may be list of more fields to reload.
+        """
+        objects = [
+            obj.materialize() if isinstance(obj, CompactObject) else obj
+            for obj in objects
+        ]
+        fields_to_load = set(fields)
+        if isinstance(force_update, (list, tuple)):
+            fields_to_load.update(force_update)
+        missing = {}
+        for obj in objects:
+            if force_update is False and fields_to_load.issubset(obj):
+                continue
+            missing.setdefault(obj.pk, []).append(obj)
+        if not missing:
+            return
+        fields_to_load.add(cls.primary_key)
+        sql, params = cls._prepare_select(
+            fields=cls.to_column(sorted(fields_to_load)),
+            where=cls._any(cls.primary_key, missing))
+        for row in await connection.fetch(sql, *params):
+            for obj in missing.get(row[cls.primary_key], ()):
+                if force_update is False:
+                    # Fields changed in the object are kept
+                    dict.update(obj, {k: v for k, v in row.items() if k not in obj})
+                else:
+                    dict.update(obj, row)
+
+    @classmethod
+    @method_connect_once(read=True)
+    async def prefetch(cls, objects, *lookups, connection=None):
+        """
+        Loads related objects of the list by one query per relationship
+        and sets them to attributes named by the relationships.
+        Nested relationships are separated by double underscore.
+
+        .. code-block::python
+
+            users = await app.m.user.get_list()
+            await app.m.user.prefetch(users, 'profile', 'groups__permissions')
+            users[0].groups[0].permissions
+
+        """
+        objects = [
+            obj.materialize() if isinstance(obj, CompactObject) else obj
+            for obj in objects
+        ]
+        # Path of the relationships => (loaded objects, their model)
+        done = {(): (objects, cls)}
+        for lookup in lookups:
+            path = ()
+            level, model = objects, cls
+            for name in lookup.split('__'):
+                path += (name,)
+                if path in done:
+                    level, model = done[path]
+                    continue
+                if name not in getattr(model, 'relationships', ()):
+                    raise ValueError('Relationship {} for {} is not found'.format(
+                        name, model.__name__))
+                relation = getattr(model, name)
+                if level:
+                    level = await relation.prefetch(level, name, connection=connection)
+                if relation.is_many_to_many:
+                    model = relation.target_model
+                else:
+                    model = relation.model_to
+                done[path] = level, model
+        return objects
+
+    @classmethod
+    def _from_rows(cls, rows, compact=None):
+        if compact is None:
+            compact = cls.compact_rows
+        if compact:
+            return [CompactObject(cls, row) for row in rows]
+        return [cls(**row) for row in rows]
+
+    @classmethod
+    def _prepare_list(cls, args, fields=None, offset=None, limit=None, sort=None,
+                      select_from=None, locale=None):
         if fields:
             fields = cls.to_column(fields)
         elif cls.fields_list:
             fields = cls.to_column(cls.fields_list)
+        fields = cls._localized_columns(fields, locale)
 
-        if fields:
-            sql = sa.select(fields).select_from(cls.table)
+        if args and args[0] is not None:
+            where = reduce(and_, args)
         else:
-            sql = cls.table.select()
+            where = None
 
-        for i in select_from or ():
-            sql = sql.select_from(i)
+        return cls._prepare_select(
+            fields=fields, where=where, sort=sort,
+            offset=offset, limit=limit, select_from=select_from)
 
-        if args and args[0] is not None:
-            sql = sql.where(reduce(and_, args))
+    @classmethod
+    async def get_list(cls, *args, connection=None, fields=None,
+                       offset=None, limit=None, sort=None,
+                       select_from=None, compact=None, cache=None,
+                       use_primary=False, locale=None):
+        """
+        Extract list.
+        With compact rows are wrapped by CompactObject without copying.
+        With cache (seconds or True for cache_ttl of the model)
+        the result is cached in Redis until the model is written.
+        With locale localized fields are selected in the language.
+        """
+        prepare = partial(
+            cls._prepare_list, args, fields=fields, sort=sort,
+            offset=offset, limit=limit, select_from=select_from, locale=locale)
+        expire = cls._cache_ttl(cache)
+        if expire and connection is None and not use_primary and not select_from:
+            columns = cls.to_column(fields or cls.fields_list or ())
+            columns = cls._localized_columns(columns or None, locale) or ()
+            where = reduce(and_, args) if args and args[0] is not None else None
+            parts = ['list', str(offset), str(limit)]
+            parts.extend(cls._select_parts(fields=columns, where=where, sort=sort))
+            # Statement is prepared only when the rows are not cached
+            result = await cls._cached_rows(
+                parts, lambda: cls._fetch(*prepare()), expire)
+        else:
+            result = await cls._fetch(
+                *prepare(), connection=connection, use_primary=use_primary)
+        return cls._from_rows(result, compact)
 
-        if offset is not None:
-            sql = sql.offset(offset)
+    @classmethod
+    @method_connect_once(read=True)
+    async def iter_list(cls, *args, connection, fields=None,
+                        offset=None, limit=None, sort=None,
+                        select_from=None, batch_size=None, prefetch=None,
+                        compact=None):
+        """
+        Iterates over list using server-side cursor in transaction.
+        Yields objects or lists of batch_size objects.
+        Close the iterator when it is not exhausted to release connection.
+        """
+        sql, params = cls._prepare_list(
+            args, fields=fields, sort=sort,
+            offset=offset, limit=limit, select_from=select_from)
+        async with connection.transaction():
+            if batch_size:
+                cursor = await connection.cursor(sql, *params)
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        break
+                    yield cls._from_rows(rows, compact)
+            else:
+                async for row in connection.cursor(
+                        sql, *params, prefetch=prefetch or cls.iter_prefetch):
+                    yield cls._from_rows((row,), compact)[0]
 
-        if limit is not None:
-            sql = sql.limit(limit)
+    @classmethod
+    def _page_sort(cls, sort):
+        """
+        Returns list of (column name, descending) pairs for keyset pagination.
+        Sort is column name or list of them, prefixed by "-" for descending order.
+        Primary key is added to make the order unique.
+        """
+        if not sort:
+            sort = ()
+        elif isinstance(sort, str):
+            sort = (sort,)
+        result = []
+        for i in sort:
+            desc = i.startswith('-')
+            name = i[1:] if desc else i
+            if name == 'pk':
+                name = cls.primary_key
+            cls.table.c[name]  # Raises KeyError for unknown column
+            result.append((name, desc))
+        if cls.primary_key not in (name for name, _ in result):
+            desc = result[-1][1] if result else False
+            result.append((cls.primary_key, desc))
+        return result
 
-        if isinstance(sort, str):
-            sql = sql.order_by(sort)
-        elif sort:
-            sql = sql.order_by(*sort)
+    @classmethod
+    def _page_salt(cls):
+        return 'dvhb_hybrid.amodels.page:' + cls.table.name
 
-        result = await connection.fetch(sql)
-        return [cls(**row) for row in result]
+    @classmethod
+    def encode_page_token(cls, obj, sort=None):
+        """Returns signed continuation token pointing after the object"""
+        sort = cls._page_sort(sort)
+        values = []
+        for name, _ in sort:
+            v = obj[name]
+            if not (v is None or isinstance(v, (bool, int, float, str))):
+                v = str(v)
+            values.append(v)
+        data = {'s': ['-' + n if d else n for n, d in sort], 'v': values}
+        return signing.dumps(data, salt=cls._page_salt(), compress=True)
+
+    @classmethod
+    def decode_page_token(cls, token, sort=None):
+        """
+        Returns where clause selecting rows after the token.
+        Raises ValueError for invalid token.
+        """
+        sort = cls._page_sort(sort)
+        try:
+            data = signing.loads(token, salt=cls._page_salt())
+        except signing.BadSignature as e:
+            raise ValueError('Invalid page token') from e
+        if data.get('s') != ['-' + n if d else n for n, d in sort] or \
+                len(data.get('v', ())) != len(sort):
+            raise ValueError('Page token does not match sort')
+
+        columns = []
+        values = []
+        for (name, _), v in zip(sort, data['v']):
+            column = cls.table.c[name]
+            if isinstance(v, str) and not isinstance(column.type, sa.String):
+                # Value is converted from its text representation by database
+                v = sa.cast(sa.cast(sa.literal(v), sa.Text), column.type)
+            columns.append(column)
+            values.append(v)
+
+        # Columns without nullable flag, e.g. of sa.table, may contain NULL,
+        # columns derived from Django have it
+        nullable = [
+            name != cls.primary_key and getattr(column, 'nullable', True)
+            for (name, _), column in zip(sort, columns)
+        ]
+        directions = {d for _, d in sort}
+        if len(directions) == 1 and not any(nullable):
+            # Row comparison can use index on sort columns
+            if directions.pop():
+                return sa.tuple_(*columns) < sa.tuple_(*values)
+            return sa.tuple_(*columns) > sa.tuple_(*values)
+        conditions = []
+        for n, ((_, desc), column, value) in enumerate(zip(sort, columns, values)):
+            equal = [
+                c.is_(None) if v is None else c == v
+                for c, v in zip(columns[:n], values[:n])
+            ]
+            # NULL is after all the values in ascending order and before them in descending one
+            if value is None:
+                if not desc:
+                    continue
+                equal.append(column.isnot(None))
+            elif desc:
+                equal.append(column < value)
+            elif nullable[n]:
+                equal.append(sa.or_(column > value, column.is_(None)))
+            else:
+                equal.append(column > value)
+            conditions.append(sa.and_(*equal))
+        return sa.or_(*conditions)
+
+    @classmethod
+    @method_connect_once(read=True)
+    async def get_page(cls, *args, connection, after=None, sort=None,
+                       limit=10, fields=None, compact=None):
+        """
+        Extract page of list using keyset pagination.
+        Returns list of objects and token of the next page or None.
+
+        :param after: token of the page returned by previous call
+        :param sort: column name or list of them, "-" prefix means descending order
+        """
+        page_sort = cls._page_sort(sort)
+        where = [i for i in args if i is not None]
+        if after:
+            where.append(cls.decode_page_token(after, sort))
+        if fields:
+            fields = list(fields)
+            fields.extend(n for n, _ in page_sort if n not in fields)
+        order_by = [
+            cls.table.c[n].desc() if d else cls.table.c[n]
+            for n, d in page_sort
+        ]
+        result = await cls.get_list(
+            *where, connection=connection, fields=fields,
+            sort=order_by, limit=limit + 1, compact=compact)
+        if len(result) > limit:
+            result = result[:limit]
+            return result, cls.encode_page_token(result[-1], sort)
+        return result, None
 
     @classmethod
-    @method_connect_once
     async def get_dict(cls, *where_and, connection=None,
-                       fields=None, sort=None, **kwargs):
+                       fields=None, sort=None, compact=None, cache=None,
+                       use_primary=False, **kwargs):
         where = []
         if where_and:
             if isinstance(where_and[0], (list, tuple, str, int)):
                 v, *where_and = where_and
                 kwargs[cls.primary_key] = v
+
+        if not fields:
+            fields = None
+        elif cls.primary_key not in fields:
+            fields.append(cls.primary_key)
+
+        found = {}
+        identity_map = IdentityMap.current()
+        if identity_map is not None and not where_and and not sort \
+                and list(kwargs) == [cls.primary_key] and kwargs[cls.primary_key]:
+            pks = kwargs[cls.primary_key]
+            if not isinstance(pks, (list, tuple)):
+                pks = [pks]
+            names = cls._field_names(fields, cls.fields_list)
+            if names is None:
+                identity_map = None
+            else:
+                missing = []
+                for pk in pks:
+                    # Keys of the result are primary keys of the rows, e.g. 5 for '5'
+                    pk = cls._identity_pk(pk)
+                    data = identity_map.get(cls.table.name, pk, names)
+                    if data is None:
+                        missing.append(pk)
+                    else:
+                        found[pk] = cls(**data)
+                if not missing:
+                    return found
+                kwargs[cls.primary_key] = missing
+        else:
+            identity_map = None
+
         for k, v in kwargs.items():
             if isinstance(v, (list, tuple)):
                 if v:
@@ -227,14 +888,16 @@ class Model(dict, metaclass=MetaModel):
             where = (reduce(and_, where),)
         else:
             where = ()
-        if not fields:
-            fields = None
-        elif cls.primary_key not in fields:
-            fields.append(cls.primary_key)
         l = await cls.get_list(
             *where, connection=connection,
-            sort=sort, fields=fields)
-        return {i.pk: i for i in l}
+            sort=sort, fields=fields, compact=compact,
+            cache=cache, use_primary=use_primary)
+        result = {i.pk: i for i in l}
+        if identity_map is not None:
+            for pk, obj in result.items():
+                identity_map.add(cls.table.name, pk, obj)
+            result.update(found)
+        return result
 
     @classmethod
     def get_table_from_django(cls, model, *jsonb, **field_type):
@@ -246,71 +909,107 @@ class Model(dict, metaclass=MetaModel):
         return table
 
     @classmethod
-    @method_connect_once
+    @method_connect_once(read=True)
     async def _pg_scalar(cls, sql, connection=None):
         return await connection.fetchval(sql)
 
+    @classmethod
+    @method_connect_once(read=True)
+    async def _estimate_count(cls, where=None, exact_below=None, connection=None):
+        """
+        Returns row count estimated by statistics of the table
+        or by planner for the filtered query.
+        Exact count is returned when estimate is less than exact_below
+        or the table has not been analyzed yet.
+        """
+        if where is None:
+            count = await connection.fetchval(
+                'SELECT reltuples FROM pg_class WHERE oid = to_regclass($1)',
+                cls.table.fullname)
+        else:
+            sql = sa.select([sa.literal_column('1')]).select_from(cls.table).where(where)
+            sql, params = compile_query(sql)
+            plan = await connection.fetchval('EXPLAIN (FORMAT JSON) ' + sql, *params)
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            count = plan[0]['Plan']['Plan Rows']
+
+        # Table without statistics has negative reltuples
+        if count is None or count < 0 or exact_below and count < exact_below:
+            sql = cls.table.count()
+            if where is not None:
+                sql = sql.where(where)
+            return await connection.fetchval(sql)
+        return int(count)
+
     @classmethod
     @method_redis_once
-    async def get_count(cls, *args, postfix=None, connection=None, redis=None, expire=180):
+    async def get_count(cls, *args, postfix=None, connection=None, redis=None, expire=180,
+                        estimate=False, exact_below=None, use_primary=False):
         """
-        Extract query size
+        Extract query size.
+        With estimate the size is taken from statistics of the table
+        or from planner, see _estimate_count.
+        It is cached by the same key as exact size.
         """
         sql = cls.table.count()
+        # Computation may run in other task unless connection is passed
+        use_primary = use_primary or cls._has_written()
 
         if args:
-            sql = sql.where(reduce(and_, args))
+            where = reduce(and_, args)
+            sql = sql.where(where)
+        else:
+            where = None
 
         async def real_count():
-            return await cls._pg_scalar(sql=sql, connection=connection)
+            if estimate:
+                return await cls._estimate_count(
+                    where, exact_below=exact_below,
+                    connection=connection, use_primary=use_primary)
+            return await cls._pg_scalar(
+                sql=sql, connection=connection, use_primary=use_primary)
 
         if expire == 0:
             return await real_count()
 
         if not postfix:
-            postfix = _hash_stmt(sql)
-
-        key = cls.get_cache_key(CACHE_CATEGORY_COUNT, postfix)
-
-        count = await redis.get(key)
-        if count is not None:
-            return int(count)
+            postfix = _statement_key([cls.table.name, where], sql)
 
-        count = await real_count()
-        await redis.set(key, count)
-        await redis.expire(key, expire)
-
-        return count
+        generation = await cls.get_generation(redis=redis)
+        key = cls.get_cache_key(CACHE_CATEGORY_COUNT, postfix, generation=generation)
+        return await RedisCached(redis, key, expire).get(
+            real_count, shared=connection is None)
 
     @classmethod
-    @method_connect_once
     @method_redis_once
     async def get_sum(cls, column, where, postfix=None, delay=0,
-                      connection=None, redis=None):
-        """Calculates sum"""
+                      connection=None, redis=None, use_primary=False):
+        """
+        Calculates sum.
+        With delay the sum is cached for delay seconds.
+        """
         sql = sa.select([func.sum(cls.table.c[column])]).where(where)
+        # Computation may run in other task unless connection is passed
+        use_primary = use_primary or cls._has_written()
 
-        if not postfix:
-            postfix = _hash_stmt(sql)
-
-        key = cls.get_cache_key(CACHE_CATEGORY_SUM, postfix)
-
-        if delay:
-            count = await redis.get(key)
-            if count is not None:
-                return int(count)
+        async def real_sum():
+            return await cls._pg_scalar(
+                sql=sql, connection=connection, use_primary=use_primary) or 0
 
-        count = await cls._pg_scalar(sql=sql, connection=connection)
+        if not delay:
+            return await real_sum()
 
-        if count is None:
-            count = 0
-        elif delay:
-            await redis.set(key, count)
-            await redis.expire(key, delay)
+        if not postfix:
+            postfix = _statement_key([cls.table.name, column, where], sql)
 
-        return count
+        generation = await cls.get_generation(redis=redis)
+        key = cls.get_cache_key(CACHE_CATEGORY_SUM, postfix, generation=generation)
+        return await RedisCached(redis, key, delay).get(
+            real_sum, shared=connection is None)
 
     @classmethod
+    @deferred
     @method_connect_once
     async def create(cls, *, connection, **kwargs):
         """Inserts new object"""
@@ -318,13 +1017,24 @@ class Model(dict, metaclass=MetaModel):
         cls.set_defaults(kwargs)
         uid = await connection.fetchval(
             cls.table.insert().returning(pk).values(kwargs))
+        await cls.invalidate_cache(connection=connection)
         kwargs[cls.primary_key] = uid
         return cls(**kwargs)
 
     @classmethod
+    @immediate
     @method_connect_once
-    async def create_many(cls, objects, connection=None, returning=True):
-        """Inserts many objects"""
+    async def create_many(cls, objects, connection=None, returning=True,
+                          copy=False, chunk_size=None):
+        """
+        Inserts many objects.
+        With copy objects are loaded by binary COPY in chunks
+        and may be any iterable.
+        """
+        if copy:
+            return await cls._copy_many(
+                objects, connection=connection,
+                returning=returning, chunk_size=chunk_size)
         pk = cls.table.c[cls.primary_key]
         sql = cls.table.insert()
         if returning:
@@ -334,44 +1044,313 @@ class Model(dict, metaclass=MetaModel):
         sql = sql.values(objects)
         if returning:
             result = await connection.fetch(sql)
+            await cls.invalidate_cache(connection=connection)
             for pk, obj in zip(result, objects):
                 obj[cls.primary_key] = pk[cls.primary_key]
             return [cls(**obj) for obj in objects]
         else:
             await connection.execute(sql)
+            await cls.invalidate_cache(connection=connection)
+
+    @classmethod
+    async def _copy_many(cls, objects, *, connection, returning, chunk_size=None):
+        """
+        Inserts objects by COPY.
+        All the objects should have the same fields after set_defaults.
+        To return primary keys rows are copied into temporary table
+        and moved by INSERT ... SELECT ... RETURNING.
+        """
+        t = cls.table
+        chunk_size = chunk_size or cls.copy_chunk_size
+        objects = iter(objects)
+        columns = processors = copy_to = None
+        result = []
+        async with connection.transaction():
+            while True:
+                chunk = list(itertools.islice(objects, chunk_size))
+                if not chunk:
+                    break
+                for obj in chunk:
+                    cls.set_defaults(obj)
+                if columns is None:
+                    columns = list(chunk[0])
+                    processors = [bind_processor(t.c[k].type) for k in columns]
+                    if returning:
+                        copy_to = await cls._create_copy_table(columns, connection=connection)
+                    else:
+                        copy_to = t
+                records = [
+                    cls._copy_record(obj, columns, processors)
+                    for obj in chunk
+                ]
+                await connection.copy_records_to_table(
+                    copy_to.name, records=records, columns=columns,
+                    schema_name=getattr(copy_to, 'schema', None))
+                if not returning:
+                    continue
+                pk = t.c[cls.primary_key]
+                rows = await connection.fetch(
+                    t.insert().from_select(
+                        columns,
+                        sa.select([copy_to.c[k] for k in columns])
+                        .order_by(copy_to.c[COLUMN_COPY_ORDER])
+                    ).returning(pk))
+                await connection.execute('TRUNCATE {}'.format(copy_to.name))
+                for row, obj in zip(rows, chunk):
+                    obj[cls.primary_key] = row[cls.primary_key]
+                    result.append(cls(**obj))
+            if returning and copy_to is not None:
+                await connection.execute('DROP TABLE {}'.format(copy_to.name))
+        await cls.invalidate_cache(connection=connection)
+        if returning:
+            return result
+
+    @classmethod
+    async def _create_copy_table(cls, columns, *, connection):
+        name = 'tmp_copy_{}'.format(uuid.uuid4().hex)
+        sql, _ = compile_query(sa.select([cls.table.c[k] for k in columns]))
+        await connection.execute(
+            'CREATE TEMPORARY TABLE {name} ON COMMIT DROP AS {sql} WITH NO DATA;'
+            'ALTER TABLE {name} ADD COLUMN {order} serial'.format(
+                name=name, sql=sql, order=COLUMN_COPY_ORDER))
+        return sa.table(
+            name,
+            sa.column(COLUMN_COPY_ORDER),
+            *(sa.column(k) for k in columns))
+
+    @classmethod
+    def _copy_record(cls, obj, columns, processors):
+        if len(obj) != len(columns) or not all(k in obj for k in columns):
+            raise ValueError('All the objects should have the same fields for copy')
+        record = []
+        for k, processor in zip(columns, processors):
+            v = obj[k]
+            if isinstance(v, ClauseElement):
+                raise ValueError('SQL expression {!r} could not be copied'.format(k))
+            elif processor is not None:
+                v = processor(v)
+            record.append(v)
+        return record
+
+    def _values_to_update(self, fields=None):
+        if fields:
+            fields = list(itertools.chain(fields, self.fields_permanent))
+            return {k: v for k, v in self.items()
+                    if k in fields}
+        elif self.fields_readonly:
+            return {k: v for k, v in self.items()
+                    if k not in self.fields_readonly}
+        return self
+
+    @classmethod
+    def _bulk_chunks(cls, objects, columns, chunk_size=None):
+        """Splits objects to chunks fitting into one statement"""
+        chunk_size = chunk_size or cls.bulk_chunk_size
+        chunk_size = max(1, min(chunk_size, MAX_PARAMETERS // max(len(columns), 1)))
+        for i in range(0, len(objects), chunk_size):
+            yield objects[i:i + chunk_size]
+
+    @classmethod
+    def _update_many_sql(cls, objects, columns, returning=False, merge=False):
+        """
+        Returns UPDATE ... FROM (VALUES ...) statement and its arguments.
+        The first of columns is primary key.
+        With merge JSONB values are merged into stored ones.
+        """
+        t = cls.table
+        table = quote(t.name)
+        names = [quote(k) for k in columns]
+        cells = []
+        for k, name in zip(columns, names):
+            type_ = base_type_name(t.c[k].type)
+            if type_ is None:
+                # Parameter takes type of the table column
+                cells.append('COALESCE(${{}}, (NULL::{}).{})'.format(table, name))
+            else:
+                # Type without length, so long value fails instead of truncation
+                cells.append('CAST(${{}} AS {})'.format(type_))
+        processors = [bind_processor(t.c[k].type) for k in columns]
+        rows = []
+        args = []
+        for obj in objects:
+            row = []
+            for k, cell, processor in zip(columns, cells, processors):
+                try:
+                    v = obj[k]
+                except KeyError:
+                    raise ValueError('Object {!r} has no field {!r}'.format(obj, k))
+                if isinstance(v, ClauseElement):
+                    raise ValueError('SQL expression {!r} could not be updated in bulk'.format(k))
+                elif processor is not None:
+                    v = processor(v)
+                args.append(v)
+                row.append(cell.format(len(args)))
+            rows.append('({})'.format(', '.join(row)))
+        sql = 'UPDATE {table} SET {values} FROM (VALUES {rows}) AS _v ({names}) ' \
+              'WHERE {table}.{pk} = _v.{pk}'.format(
+                  table=table,
+                  values=', '.join(
+                      (_MERGE_JSON if merge else '{0} = _v.{0}').format(k, table)
+                      for k in names[1:]),
+                  rows=', '.join(rows),
+                  names=', '.join(names),
+                  pk=names[0])
+        if returning:
+            sql += ' RETURNING {}.*'.format(table)
+        return sql, args
+
+    @classmethod
+    @immediate
+    @method_connect_once
+    async def update_many(cls, objects, fields=None, *, connection=None,
+                          returning=False, chunk_size=None, merge=False):
+        """
+        Updates fields of the objects by primary key
+        using UPDATE ... FROM (VALUES ...) per chunk of objects.
+        Fields are taken from the first object by default.
+        With returning updated objects are returned.
+        With merge JSONB fields are merged like by update_json.
+        """
+        objects = list(objects)
+        if not objects:
+            return [] if returning else None
+        if not merge:
+            for obj in objects:
+                cls.set_defaults(obj)
+        if merge:
+            # Only JSONB fields are updated
+            fields = list(fields or (k for k in objects[0] if k != cls.primary_key))
+        elif fields:
+            # Permanent fields are saved when objects have them like by save
+            fields = list(itertools.chain(
+                fields, (k for k in cls.fields_permanent if k in objects[0])))
+        else:
+            fields = [k for k in objects[0] if k not in cls.fields_readonly]
+        columns = [cls.primary_key]
+        columns.extend(k for k in dict.fromkeys(fields) if k != cls.primary_key)
+        if len(columns) == 1:
+            raise ValueError('Nothing to update')
+        result = []
+        for chunk in cls._bulk_chunks(objects, columns, chunk_size):
+            sql, args = cls._update_many_sql(
+                chunk, columns, returning=returning, merge=merge)
+            if returning:
+                result.extend(cls(**row) for row in await connection.fetch(sql, *args))
+            else:
+                await connection.execute(sql, *args)
+        for obj in objects:
+            cls._discard_identity(obj[cls.primary_key])
+        await cls.invalidate_cache(connection=connection)
+        if returning:
+            return result
+
+    @classmethod
+    @immediate
+    @method_connect_once
+    async def upsert_many(cls, objects, conflict=None, fields=None, *,
+                          connection=None, returning=False, chunk_size=None):
+        """
+        Inserts objects or updates existing ones
+        using INSERT ... ON CONFLICT per chunk of objects.
+        Conflict is list of unique columns, primary key by default.
+        Fields to update on conflict are all the fields of the objects by default.
+        With returning inserted and updated objects are returned.
+        """
+        t = cls.table
+        objects = list(objects)
+        if not objects:
+            return [] if returning else None
+        for obj in objects:
+            cls.set_defaults(obj)
+        conflict = list(conflict or (cls.primary_key,))
+        if fields:
+            fields = list(itertools.chain(fields, cls.fields_permanent))
+        else:
+            fields = [k for k in objects[0] if k not in cls.fields_readonly]
+        fields = [k for k in dict.fromkeys(fields) if k not in conflict]
+        columns = set(itertools.chain.from_iterable(objects))
+        result = []
+        for chunk in cls._bulk_chunks(objects, columns, chunk_size):
+            sql = pg_insert(t).values(chunk)
+            if fields:
+                sql = sql.on_conflict_do_update(
+                    index_elements=conflict,
+                    set_={k: sql.excluded[k] for k in fields})
+            else:
+                sql = sql.on_conflict_do_nothing(index_elements=conflict)
+            if returning:
+                rows = await connection.fetch(sql.returning(*t.c))
+                result.extend(cls(**row) for row in rows)
+            else:
+                await connection.execute(sql)
+        cls._discard_identity()
+        await cls.invalidate_cache(connection=connection)
+        if returning:
+            return result
 
+    @deferred
     @method_connect_once
-    async def save(self, *, fields=None, connection):
+    async def save(self, *, fields=None, upsert=None, connection):
+        if upsert is None:
+            upsert = self.use_upsert
+        if upsert:
+            await self.upsert(fields=fields, connection=connection)
+            return self.pk
         pk_field = self.table.c[self.primary_key]
         self.set_defaults(self)
         if self.primary_key in self:
+            self._discard_identity(self.pk)
             saved = await self._get_one(self.pk, connection=connection)
         else:
             saved = False
         if not saved:
             pk = await connection.fetchval(
                 self.table.insert().returning(pk_field).values(self))
+            await self.invalidate_cache(connection=connection)
             self[self.primary_key] = pk
             return pk
-        if fields:
-            fields = list(itertools.chain(fields, self.fields_permanent))
-            values = {k: v for k, v in self.items()
-                      if k in fields}
-        elif self.fields_readonly:
-            values = {k: v for k, v in self.items()
-                      if k not in self.fields_readonly}
-        else:
-            values = self
+        values = self._values_to_update(fields)
         pk = await connection.fetchval(
             self.table.update()
             .where(pk_field == self.pk)
             .returning(pk_field)
             .values(values)
         )
+        await self.invalidate_cache(connection=connection)
         assert self.pk == pk
 
         return pk
 
+    @immediate
+    @method_connect_once
+    async def upsert(self, *, fields=None, connection):
+        """
+        Inserts or updates object using single query.
+        Returns True if the object was created.
+        """
+        pk_field = self.table.c[self.primary_key]
+        self.set_defaults(self)
+        sql = pg_insert(self.table).values(self)
+        if self.primary_key in self:
+            self._discard_identity(self.pk)
+            values = {
+                k: sql.excluded[k]
+                for k in self._values_to_update(fields)
+                if k != self.primary_key
+            }
+            if values:
+                sql = sql.on_conflict_do_update(index_elements=[pk_field], set_=values)
+            else:
+                sql = sql.on_conflict_do_nothing(index_elements=[pk_field])
+        r = await connection.fetchrow(sql.returning(pk_field, _column_created()))
+        await self.invalidate_cache(connection=connection)
+        if r is None:
+            # Object exists and there is nothing to update
+            return False
+        self[self.primary_key] = r[self.primary_key]
+        return r[COLUMN_CREATED]
+
+    @immediate
     @method_connect_once
     async def update_increment(self, connection=None, **kwargs):
         t = self.table
@@ -380,13 +1359,16 @@ class Model(dict, metaclass=MetaModel):
             t.c[field]: t.c[field] + value
             for field, value in kwargs.items()
         }
+        self._discard_identity(self.pk)
 
         await connection.execute(
             t.update().where(
                 t.c[self.primary_key] == self.pk
             ).values(dict_update))
+        await self.invalidate_cache(connection=connection)
 
     @classmethod
+    @deferred
     @method_connect_once
     async def update_fields(cls, where, connection=None, **kwargs):
         t = cls.table
@@ -395,15 +1377,17 @@ class Model(dict, metaclass=MetaModel):
             t.c[field]: value
             for field, value in kwargs.items()
         }
+        cls._discard_identity()
 
         await connection.execute(
             t.update().
             where(where).
             values(dict_update))
+        await cls.invalidate_cache(connection=connection)
 
-    @method_connect_once
-    async def update_json(self, *args, connection=None, **kwargs):
-        t = self.table
+    @staticmethod
+    def _json_values(args, kwargs):
+        """Returns dict field => JSON to merge from arguments of update_json"""
         if args:
             if len(args) > 1 and not kwargs:
                 field, *path, value = args
@@ -412,9 +1396,17 @@ class Model(dict, metaclass=MetaModel):
                 value = kwargs
             for p in reversed(path):
                 value = {p: value}
-            kwargs = {field: value}
+            return {field: value}
         elif not kwargs:
             raise ValueError('Need args or kwargs')
+        return kwargs
+
+    @deferred
+    @method_connect_once
+    async def update_json(self, *args, connection=None, **kwargs):
+        t = self.table
+        kwargs = self._json_values(args, kwargs)
+        self._discard_identity(self.pk)
 
         await connection.fetchval(
             t.update().where(
@@ -427,50 +1419,134 @@ class Model(dict, metaclass=MetaModel):
                     for field, value in kwargs.items()
                 }
             ).returning(t.c[self.primary_key]))
+        await self.invalidate_cache(connection=connection)
+
+    @classmethod
+    def _json_paths_values(cls, paths):
+        """Returns dict column => expression setting and deleting paths of JSONB"""
+        t = cls.table
+        fields = {}
+        for path, value in paths.items():
+            if isinstance(path, str):
+                path = path,
+            field, *path = path
+            fields.setdefault(field, []).append((path, value))
+        result = {}
+        for field, changes in fields.items():
+            column = t.c[field]
+            expr = sa.func.coalesce(column, sa.cast({}, JSONB))
+            # Missing parents are created as objects before the changes
+            parents = sorted({
+                tuple(path[:i])
+                for path, value in changes if value is not JSON_DELETE
+                for i in range(1, len(path))
+            }, key=len)
+            for path in parents:
+                expr = sa.func.jsonb_set(expr, _json_path(path), sa.func.coalesce(
+                    column.op('#>')(_json_path(path)), sa.cast({}, JSONB)))
+            for path, value in changes:
+                if not path:
+                    expr = None if value is JSON_DELETE else sa.cast(value, JSONB)
+                elif value is JSON_DELETE:
+                    expr = expr.op('#-')(_json_path(path))
+                else:
+                    expr = sa.func.jsonb_set(expr, _json_path(path), sa.cast(value, JSONB))
+            result[column] = expr
+        return result
+
+    @classmethod
+    @immediate
+    @method_connect_once
+    async def update_json_paths(cls, target, paths, *, connection=None):
+        """
+        Sets or deletes nested keys of JSONB fields by one UPDATE.
+        Target is the object, list of objects or primary keys or where clause.
+        Paths are tuples of field and keys, value JSON_DELETE deletes the key.
+
+        .. code-block::python
+
+            await app.m.image.update_json_paths(image, {
+                ('meta', 'exif', 'width'): 100,
+                ('meta', 'exif', 'thumbnail'): JSON_DELETE,
+            })
+
+        """
+        if not paths:
+            raise ValueError('Need paths')
+        pk = cls.primary_key
+        if isinstance(target, ClauseElement):
+            where = target
+            cls._discard_identity()
+        else:
+            if isinstance(target, (dict, CompactObject)):
+                target = [target]
+            pks = [i[pk] if isinstance(i, (dict, CompactObject)) else i for i in target]
+            if not pks:
+                return
+            where = cls._any(pk, pks)
+            for i in pks:
+                cls._discard_identity(i)
+        await connection.execute(
+            cls.table.update().where(where).values(cls._json_paths_values(paths)))
+        await cls.invalidate_cache(connection=connection)
 
     @classmethod
+    @immediate
     @method_connect_once
     async def delete_where(cls, *where, connection=None):
         t = cls.table
 
         where = cls._where(where)
+        cls._discard_identity()
 
         await connection.fetchval(
             t.delete().where(*where))
+        await cls.invalidate_cache(connection=connection)
 
+    @immediate
     @method_connect_once
     async def delete(self, connection=None):
-        async with connection.transaction():
+        self._discard_identity(self.pk)
+        async with AfterCommit(connection), connection.transaction():
             await self._delete_relationships(connection=connection)
             pk_field = self.table.c[self.primary_key]
             await connection.fetchval(self.table.delete().where(pk_field == self.pk))
+        await self.invalidate_cache(connection=connection)
 
     @method_connect_once
     async def _delete_relationships(self, connection=None):
         if not hasattr(self, 'relationships'):
             return
-        for k in self.relationships:
-            relation = getattr(self, k, None)
-            if relation is None:
-                raise AttributeError('Relationship {} for {} is not found'.format(
-                    k,
-                    type(self).__name__
-                ))
-            if relation.is_many_to_many:
-                await relation.delete_by_source(self.pk, connection=connection)
-            elif relation.is_one_to_many:
-                await relation.delete_related(self.pk, connection=connection)
-            elif relation.is_one_to_one:
-                await relation.delete_related(self.pk, connection=connection)
+        from .relations import DeletePlan
+        await DeletePlan.get(type(self)).delete_related([self.pk], connection=connection)
+
+    @classmethod
+    def _is_pk_lookup(cls, args, kwargs):
+        if args:
+            return not kwargs and len(args) == 1 and isinstance(args[0], (int, str, uuid.UUID))
+        return len(kwargs) == 1 and ('pk' in kwargs or cls.primary_key in kwargs)
 
     @classmethod
+    @immediate
     @method_connect_once
-    async def get_or_create(cls, *args, defaults=None, connection, **kwargs):
+    async def get_or_create(cls, *args, defaults=None, conflict=None, connection, **kwargs):
+        """
+        Returns object and flag it was created.
+        With conflict (list of unique columns) or use_upsert and lookup
+        by primary key the object is obtained by single INSERT ... ON CONFLICT DO NOTHING
+        which selects existing row without writing it.
+        """
         if args or kwargs:
             pass
         elif cls.primary_key in defaults:
             args = (defaults[cls.primary_key],)
 
+        if conflict is None and cls.use_upsert and cls._is_pk_lookup(args, kwargs):
+            conflict = (cls.primary_key,)
+        if conflict:
+            return await cls._get_or_create_upsert(
+                args, kwargs, defaults=defaults, conflict=conflict, connection=connection)
+
         if args or kwargs:
             saved = await cls._get_one(
                 *args, connection=connection, **kwargs)
@@ -485,10 +1561,48 @@ class Model(dict, metaclass=MetaModel):
             cls.table.insert().returning(
                 cls.table.c[cls.primary_key]
             ).values(kwargs))
+        await cls.invalidate_cache(connection=connection)
         obj = cls(**kwargs)
         obj.pk = pk
         return obj, True
 
+    @classmethod
+    async def _get_or_create_upsert(cls, args, kwargs, *, defaults, conflict, connection):
+        if args:
+            if not cls._is_pk_lookup(args, {}):
+                raise ValueError('Only primary key or keyword arguments could be used with conflict')
+            kwargs[cls.primary_key] = args[0]
+        elif 'pk' in kwargs:
+            kwargs[cls.primary_key] = kwargs.pop('pk')
+        if defaults:
+            kwargs.update(defaults)
+        cls.set_defaults(kwargs)
+
+        t = cls.table
+        target = cls.to_column(conflict)
+        missing = [c.name for c in target if c.name not in kwargs]
+        if missing:
+            raise ValueError('Values of conflict columns are required: {}'.format(', '.join(missing)))
+        lookup = reduce(and_, [c == kwargs[c.name] for c in target])
+        # Existing row is selected by the same statement without writing it
+        inserted = pg_insert(t).values(kwargs).on_conflict_do_nothing(
+            index_elements=target).returning(*t.c).cte('inserted')
+        sql = sa.union_all(
+            sa.select([*inserted.c, sa.true().label(COLUMN_CREATED)]),
+            sa.select([*t.c, sa.false().label(COLUMN_CREATED)]).where(lookup).where(
+                ~sa.exists().select_from(inserted)),
+        )
+        r = await connection.fetchrow(sql)
+        if r is None:
+            # Conflicting row is committed after start of the statement
+            r = await connection.fetchrow(
+                sa.select([*t.c, sa.false().label(COLUMN_CREATED)]).where(lookup))
+        r = dict(r)
+        created = r.pop(COLUMN_CREATED)
+        if created:
+            await cls.invalidate_cache(connection=connection)
+        return cls(**r), created
+
     @classmethod
     def validate(cls, data, to_class=True, default_validator=True):
         """Returns valid object or exception"""
@@ -525,6 +1639,45 @@ class Model(dict, metaclass=MetaModel):
             except dtrans.NotRegistered:
                 pass
 
+    @classmethod
+    def _translation_columns(cls):
+        """Returns names of the columns with translations of localized fields"""
+        columns = cls.__dict__.get('_translation_column_names')
+        if columns is None:
+            from django.conf import settings
+            languages = getattr(settings, 'MODELTRANSLATION_LANGUAGES', None) or \
+                [code for code, name in settings.LANGUAGES]
+            columns = frozenset(
+                '{}_{}'.format(field, lang.replace('-', '_'))
+                for field in cls.fields_localized or ()
+                for lang in languages
+            ).intersection(cls.table.c.keys())
+            cls._translation_column_names = columns
+        return columns
+
+    @classmethod
+    def _localized_columns(cls, fields, locale):
+        """
+        Returns columns where localized fields are replaced by
+        COALESCE(NULLIF(field_<lang>, ''), field) AS field.
+        Columns of translations are not selected by default.
+        """
+        if not locale or not cls.fields_localized:
+            return fields
+        lang = str(getattr(locale, 'language', locale)).replace('-', '_')
+        c = cls.table.c
+        if not fields:
+            translations = cls._translation_columns()
+            fields = [i for i in c if i.name not in translations]
+        result = []
+        for column in fields:
+            name = getattr(column, 'name', None)
+            translation = '{}_{}'.format(name, lang)
+            if name in cls.fields_localized and translation in c and column is c[name]:
+                column = sa.func.coalesce(sa.func.nullif(c[translation], ''), column).label(name)
+            result.append(column)
+        return result
+
     @classmethod
     def localize(cls, obj, locale):
         if not cls.fields_localized:
@@ -537,7 +1690,11 @@ class Model(dict, metaclass=MetaModel):
                 obj[field] = value
 
 
-def _hash_stmt(stmt):
-    compiled = stmt.compile()
-    msg = compiled.string + repr(compiled.params)
-    return utils.get_hash(msg)
+def _column_created():
+    # xmax of the row is zero if it was inserted and not updated
+    return sa.literal_column('(xmax = 0)').label(COLUMN_CREATED)
+
+
+def _statement_key(parts, stmt):
+    """Returns cache key of the statement built of the parts"""
+    return statement_key(parts) or hash_statement(stmt)
@@ -0,0 +1,45 @@
+import asyncio
+
+from .lazy import LazyConnection
+
+
+def _holds_connection(connection):
+    """Returns True when the caller holds connection: passed or acquired lazy one"""
+    if connection is not None:
+        return True
+    connection = LazyConnection.current()
+    return connection is not None and connection.acquired
+
+
+async def gather(app, *reads, connection=None, limit=4):
+    """
+    Runs independent reads concurrently and returns their results in order.
+    Reads are callables accepting connection and returning awaitable,
+    e.g. functools.partial(model.get_one, pk).
+    Every read runs in own task and acquires own connection from the pool,
+    at most limit of them at once.
+    Reads run one by one on connection of the caller when it holds one
+    (passed or acquired lazy connection of the task), because callers
+    waiting for more connections while holding one may exhaust the pool
+    and other connections do not see changes of its transaction.
+    """
+    if len(reads) < 2 or limit == 1 or _holds_connection(connection):
+        return [await read(connection=connection) for read in reads]
+    semaphore = asyncio.Semaphore(limit)
+    router = app.get('db_router')
+    written = router is not None and router.has_written()
+
+    async def run(read):
+        async with semaphore:
+            if written:
+                # Reads of the task see its writes
+                router.written()
+            return await read()
+
+    tasks = [asyncio.ensure_future(run(read)) for read in reads]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
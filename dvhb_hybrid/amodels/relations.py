@@ -1,5 +1,6 @@
 from collections import defaultdict
 
+import sqlalchemy as sa
 from django.db.models import (
     CASCADE,
     PROTECT,
@@ -120,15 +121,29 @@ class ManyToManyFactory:
 
 
 class ManyToOneFactory:
-    def __init__(self):
-        pass
+    def __init__(self, model_from, model_to, column_from, column_to):
+        self.model_from = model_from
+        self.model_to = model_to
+        self.column_from = column_from
+        self.column_to = column_to
 
     def __call__(self, app):
-        return ManyToOneRelationship(app)
+        return ManyToOneRelationship(
+            app=app,
+            model_from=_obtain_model(app, self.model_from),
+            model_to=_obtain_model(app, self.model_to),
+            column_from=self.column_from,
+            column_to=self.column_to
+        )
 
     @classmethod
     def from_django(cls, field):
-        return cls()
+        return cls(
+            model_from=field.model,
+            model_to=field.related_model,
+            column_from=field.attname,
+            column_to=field.target_field.attname
+        )
 
 
 class OneToManyFactory:
@@ -208,6 +223,34 @@ class BaseRelationship:
     def is_one_to_one(self):
         raise NotImplementedError()
 
+    async def prefetch(self, objects, name, *, connection=None):
+        """
+        Loads related objects for all the objects by one query
+        and sets them to attribute name of every object.
+        Returns list of loaded related objects.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _attach(obj, name, value):
+        # Value of instance shadows the relationship descriptor
+        # and does not become a field of the object
+        object.__setattr__(obj, name, value)
+
+    async def _prefetch_single(self, objects, name, model_from, column_from, connection):
+        """Prefetches relationship with at most one related object"""
+        await model_from.load_fields_many(objects, column_from.name, connection=connection)
+        values = {obj[column_from.name] for obj in objects} - {None}
+        related = {}
+        if values:
+            for i in await self.model_to.get_list(
+                    self.model_to._any(self.column_to.name, values),
+                    connection=connection, compact=False):
+                related[i[self.column_to.name]] = i
+        for obj in objects:
+            self._attach(obj, name, related.get(obj[column_from.name]))
+        return list(related.values())
+
 
 class ManyToManyRelationship(BaseRelationship):
     def __init__(self, app, model, target_model, source_field, target_field):
@@ -250,7 +293,7 @@ class ManyToManyRelationship(BaseRelationship):
     def _get_target_where_condition(self, target):
         return self._get_where_condition(self.target_field, target)
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def get_links_by_source(self, source, *, connection=None):
         """
         Returns links given source model ID/IDs
@@ -260,7 +303,7 @@ class ManyToManyRelationship(BaseRelationship):
         where = self._get_source_where_condition(source)
         return await self.model.get_list(where, connection=connection)
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def get_links_by_target(self, target, *, connection=None):
         """
         Returns links given target model ID/IDs
@@ -270,7 +313,7 @@ class ManyToManyRelationship(BaseRelationship):
         where = self._get_target_where_condition(target)
         return await self.model.get_list(where, connection=connection)
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def _get_targets(self, links, *, as_dict=False, connection=None):
         target_ids = [i[self.target_field] for i in links]
         pk_name = self.target_model.primary_key
@@ -280,12 +323,12 @@ class ManyToManyRelationship(BaseRelationship):
             targets = {i[pk_name]: i for i in targets}
         return targets
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def get_for_one(self, source, *, connection=None):
         links = await self.get_links_by_source(source, connection=connection)
         return await self._get_targets(links, connection=connection)
 
-    @method_connect_once
+    @method_connect_once(read=True)
     async def get_for_list(self, source, *, connection=None):
         links = await self.get_links_by_source(source, connection=connection)
         targets = await self._get_targets(links, as_dict=True, connection=connection)
@@ -296,6 +339,33 @@ class ManyToManyRelationship(BaseRelationship):
             result[source_key].append(targets[target_key])
         return dict(result)
 
+    @method_connect_once(read=True)
+    async def prefetch(self, objects, name, *, connection=None):
+        """
+        Loads targets of all the objects by one query of the link table
+        joined with the target table, targets are shared between objects
+        """
+        objects = list(objects)
+        source = self.model.table.c[self.source_field]
+        link_to = self.model.table.c[self.target_field]
+        target = self.target_model.table
+        pk = target.c[self.target_model.primary_key]
+        sql = sa.select([target, source.label('_prefetch_source')]).select_from(
+            self.model.table.join(target, link_to == pk),
+        ).where(self.model._any(self.source_field, {i.pk for i in objects}))
+        result = defaultdict(list)
+        targets = {}
+        for row in await connection.fetch(sql):
+            row = dict(row)
+            source_key = row.pop('_prefetch_source')
+            obj = targets.get(row[pk.name])
+            if obj is None:
+                obj = targets[row[pk.name]] = self.target_model(**row)
+            result[source_key].append(obj)
+        for obj in objects:
+            self._attach(obj, name, result.get(obj.pk, []))
+        return list(targets.values())
+
     async def delete(self, source, *, connection=None):
         """
         For backward compatibility
@@ -326,9 +396,13 @@ class ManyToManyRelationship(BaseRelationship):
         await self.model.delete_where(where, connection=connection)
 
 
-class ManyToOneRelationship(BaseRelationship):  # TODO: implement many to one relationship
-    def __init__(self, app):
+class ManyToOneRelationship(BaseRelationship):
+    def __init__(self, app, model_from, model_to, column_from, column_to):
         self.app = app
+        self.model_from = model_from
+        self.model_to = model_to
+        self._column_from = model_from.table.c[column_from]
+        self._column_to = model_to.table.c[column_to]
 
     @property
     def is_many_to_many(self):
@@ -346,6 +420,17 @@ class ManyToOneRelationship(BaseRelationship):  # TODO: implement many to one re
     def is_one_to_one(self):
         return False
 
+    @property
+    def column_to(self):
+        return self._column_to
+
+    @method_connect_once(read=True)
+    async def prefetch(self, objects, name, *, connection=None):
+        """Loads objects referenced by foreign key of the objects"""
+        objects = list(objects)
+        return await self._prefetch_single(
+            objects, name, self.model_from, self._column_from, connection)
+
 
 class OneToManyRelationship(BaseRelationship):
     def __init__(self, app, model_to, column_to, on_delete):
@@ -370,6 +455,28 @@ class OneToManyRelationship(BaseRelationship):
     def is_one_to_one(self):
         return False
 
+    @property
+    def column_to(self):
+        return self._column_to
+
+    @property
+    def on_delete(self):
+        return self._on_delete
+
+    @method_connect_once(read=True)
+    async def prefetch(self, objects, name, *, connection=None):
+        """Loads lists of objects referencing the objects"""
+        objects = list(objects)
+        result = defaultdict(list)
+        related = await self.model_to.get_list(
+            self.model_to._any(self._column_to.name, {i.pk for i in objects}),
+            connection=connection, compact=False)
+        for i in related:
+            result[i[self._column_to.name]].append(i)
+        for obj in objects:
+            self._attach(obj, name, result.get(obj.pk, []))
+        return related
+
     @method_connect_once
     async def delete_related(self, object_id, connection=None):
         if self._on_delete is CASCADE:
@@ -420,6 +527,21 @@ class OneToOneRelationship(BaseRelationship):
     def is_one_to_one(self):
         return True
 
+    @property
+    def column_to(self):
+        return self._column_to
+
+    @property
+    def on_delete(self):
+        return self._on_delete
+
+    @method_connect_once(read=True)
+    async def prefetch(self, objects, name, *, connection=None):
+        """Loads related object of every object or None"""
+        objects = list(objects)
+        return await self._prefetch_single(
+            objects, name, self.model_from, self._column_from, connection)
+
     @method_connect_once
     async def delete_related(self, object_id, connection):
         if self._on_delete is CASCADE:
@@ -443,3 +565,104 @@ class OneToOneRelationship(BaseRelationship):
                     self._column_to.name,
                     object_id
                 ))
+
+
+class DeletePlan:
+    """
+    Steps to delete objects of the model with related objects.
+    Relationships are walked once per model and every step
+    is done by one set-based statement for all the objects.
+
+    .. code-block::python
+
+        plan = DeletePlan.get(app.m.user)
+        await plan.delete([user_id1, user_id2], connection=connection)
+
+    """
+
+    def __init__(self, model):
+        self.app = model.app  # required for method_connect_once
+        self.model = model
+        # (link model, column to source)
+        self.links = []
+        # (related model, column to the model)
+        self.protect = []
+        self.set_null = []
+        self.cascade = []
+        for k in getattr(model, 'relationships', ()):
+            relation = getattr(model, k, None)
+            if relation is None:
+                raise AttributeError('Relationship {} for {} is not found'.format(
+                    k, model.__name__))
+            if relation.is_many_to_many:
+                self.links.append((relation.model, relation.source_field))
+            elif relation.is_one_to_many or relation.is_one_to_one:
+                step = relation.model_to, relation.column_to.name
+                if relation.on_delete is CASCADE:
+                    self.cascade.append(step)
+                elif relation.on_delete is PROTECT:
+                    self.protect.append(step)
+                elif relation.on_delete is SET_NULL:
+                    self.set_null.append(step)
+
+    @classmethod
+    def get(cls, model):
+        """Returns plan of the model built once"""
+        plan = model.__dict__.get('_delete_plan')
+        if plan is None:
+            plan = cls(model)
+            model._delete_plan = plan
+        return plan
+
+    @property
+    def is_empty(self):
+        return not (self.links or self.protect or self.set_null or self.cascade)
+
+    @method_connect_once
+    async def delete_related(self, pks, *, connection=None, _deleted=None):
+        """
+        Deletes or updates objects related to the objects with primary keys
+        or raises RelationshipException if some of them are protected
+        """
+        pks = list(pks)
+        if not pks:
+            return
+        if _deleted is None:
+            _deleted = defaultdict(set)
+        for model, column in self.protect:
+            exists = await connection.fetchval(
+                sa.select([sa.exists().where(model._any(column, pks))]))
+            if exists:
+                raise RelationshipException('Could not delete {} where {} in {}'.format(
+                    model.__name__, column, pks))
+        for model, column in self.links:
+            await model.delete_where(model._any(column, pks), connection=connection)
+        for model, column in self.set_null:
+            await model.update_fields(
+                model._any(column, pks), connection=connection, **{column: None})
+        for model, column in self.cascade:
+            plan = self.get(model)
+            where = model._any(column, pks)
+            if plan.is_empty:
+                await model.delete_where(where, connection=connection)
+                continue
+            pk = model.table.c[model.primary_key]
+            rows = await connection.fetch(sa.select([pk]).where(where))
+            deleted = _deleted[model.table.name]
+            # Cycles of references are deleted once
+            related = [r[0] for r in rows if r[0] not in deleted]
+            deleted.update(related)
+            await plan.delete(related, connection=connection, _deleted=_deleted)
+
+    @method_connect_once
+    async def delete(self, pks, *, connection=None, _deleted=None):
+        """Deletes objects with primary keys and related objects"""
+        pks = list(pks)
+        if not pks:
+            return
+        model = self.model
+        if _deleted is None:
+            _deleted = defaultdict(set)
+        _deleted[model.table.name].update(pks)
+        await self.delete_related(pks, connection=connection, _deleted=_deleted)
+        await model.delete_where(model._any(model.primary_key, pks), connection=connection)
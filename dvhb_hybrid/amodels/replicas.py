@@ -0,0 +1,43 @@
+import random
+import time
+from weakref import WeakKeyDictionary
+
+from .identity import _current_task
+
+
+class ReplicaRouter:
+    """
+    Chooses pool of the connection: reads go to one of replicas,
+    writes and reads of the task which has written recently go to primary.
+
+    :param primary: pool of primary database
+    :param replicas: pools of replicas
+    :param window: seconds to read from primary after write of the task
+    """
+    # Task => time of the last write
+    writes = WeakKeyDictionary()
+
+    def __init__(self, primary, replicas=(), window=5):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.window = window
+
+    def pool(self, read=False, use_primary=False):
+        """Returns pool to acquire connection from"""
+        if not read or use_primary or not self.replicas or self.has_written():
+            return self.primary
+        return random.choice(self.replicas)
+
+    def written(self):
+        """Marks the current task has written to primary, writes of models call it"""
+        task = _current_task()
+        if task is not None:
+            self.writes[task] = time.monotonic()
+
+    def has_written(self):
+        """Returns True if the current task has written within the window"""
+        task = _current_task()
+        if task is None:
+            return False
+        last = self.writes.get(task)
+        return last is not None and time.monotonic() - last < self.window
@@ -0,0 +1,351 @@
+import functools
+from weakref import WeakKeyDictionary
+
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import ClauseElement
+
+from .commit import AfterCommit
+from .decorators import method_connect_once
+from .identity import _current_task
+
+
+def deferred(func):
+    """
+    Records call of the model method in the unit of work of the task
+    instead of running it. Calls with connection are run at once
+    after flush of pending writes, they are parts of the transaction of the caller.
+    """
+    @functools.wraps(func)
+    async def wrapper(target, *args, **kwargs):
+        uow = UnitOfWork._active(target)
+        if uow is None:
+            return await func(target, *args, **kwargs)
+        elif kwargs.get('connection') is not None:
+            args, kwargs = await uow._flush_before(args, kwargs)
+            return await func(target, *args, **kwargs)
+        kwargs.pop('use_primary', None)
+        return getattr(uow, '_' + func.__name__)(target, *args, **kwargs)
+    return wrapper
+
+
+def immediate(func):
+    """
+    Flushes pending writes of the unit of work of the task
+    before call of the model method which is not deferred,
+    so writes are done in order of calls. PendingKey in arguments
+    are replaced by primary keys of the created rows.
+    """
+    @functools.wraps(func)
+    async def wrapper(target, *args, **kwargs):
+        uow = UnitOfWork._active(target)
+        if uow is not None:
+            args, kwargs = await uow._flush_before(args, kwargs)
+        return await func(target, *args, **kwargs)
+    return wrapper
+
+
+class PendingKey:
+    """
+    Primary key of the object created within unit of work.
+    It may be used in other writes of the unit and is replaced
+    by the key of the inserted row on flush.
+    """
+    __slots__ = ('obj', 'step')
+
+    def __init__(self, obj, step):
+        self.obj = obj
+        self.step = step
+
+    def __repr__(self):
+        return '<PendingKey of {}>'.format(type(self.obj).__name__)
+
+    def resolve(self):
+        pk = self.obj.get(self.obj.primary_key)
+        if pk is None or isinstance(pk, PendingKey):
+            raise RuntimeError('Object {!r} is not created yet'.format(self.obj))
+        return pk
+
+
+def _resolve(value):
+    if isinstance(value, PendingKey):
+        return value.resolve()
+    return value
+
+
+def _resolve_bind(bind):
+    bind.value = _resolve(bind.value)
+
+
+def _resolve_argument(value):
+    """Replaces PendingKey in argument of the write, objects are changed in place"""
+    if isinstance(value, PendingKey):
+        return value.resolve()
+    elif isinstance(value, ClauseElement):
+        return visitors.cloned_traverse(value, {}, {'bindparam': _resolve_bind})
+    elif isinstance(value, dict):
+        for k, v in list(value.items()):
+            if isinstance(v, PendingKey):
+                value[k] = v.resolve()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_resolve_argument(i) for i in value)
+    return value
+
+
+class _Step:
+    def __init__(self, kind, model, fields=None, where=None):
+        self.kind = kind
+        self.model = model
+        self.fields = fields
+        self.where = where
+        # Primary key => values, objects to insert or values of update_fields
+        self.rows = {}
+
+    def _rows(self):
+        return [
+            {k: _resolve(v) for k, v in row.items()}
+            for row in self.rows.values()
+        ]
+
+    async def run(self, connection):
+        model = self.model
+        if self.kind == 'insert':
+            # Objects are inserted as they are at flush
+            groups = {}
+            for obj in self.rows.values():
+                for k, v in list(obj.items()):
+                    if not isinstance(v, PendingKey):
+                        continue
+                    elif v.obj is obj:
+                        del obj[k]
+                    else:
+                        obj[k] = v.resolve()
+                groups.setdefault(tuple(obj), []).append(obj)
+            for objects in groups.values():
+                await model.create_many(objects, connection=connection)
+        elif self.kind == 'update':
+            await model.update_many(self._rows(), self.fields, connection=connection)
+        elif self.kind == 'upsert':
+            groups = {}
+            for row in self._rows():
+                groups.setdefault(tuple(row), []).append(row)
+            for rows in groups.values():
+                await model.upsert_many(rows, fields=self.fields, connection=connection)
+        elif self.kind == 'json':
+            await model.update_many(
+                self._rows(), self.fields, connection=connection, merge=True)
+        elif self.kind == 'fields':
+            where = self.where
+            if where is not None:
+                where = visitors.cloned_traverse(where, {}, {'bindparam': _resolve_bind})
+            await model.update_fields(
+                where, connection=connection,
+                **{k: _resolve(v) for k, v in self.rows.items()})
+
+
+class UnitOfWork:
+    """
+    Collects writes of the models within the task and flushes them
+    in one transaction on exit. Writes of the same kind, model and fields
+    are done by one statement: created objects by multi-row INSERT,
+    saved objects by UPDATE ... FROM (VALUES ...).
+    Steps are run in order of the first call, update_fields
+    closes batches of its model to keep order of writes.
+
+    Writes return at once: created objects get primary key on flush,
+    till then it is PendingKey which may be used in later writes of the unit,
+    reads within the unit do not see pending writes.
+    Calls with connection are not deferred. They and writes which are
+    not deferred (delete, update_many, ...) flush pending writes first.
+
+    .. code-block::python
+
+        async with app.m.unit_of_work():
+            user.last_login = utils.now()
+            await user.save(fields=['last_login'])
+            await app.m.user_action_log_entry.create(user_id=user.pk, ...)
+            await user.update_json('oauth_info', 'facebook', info)
+
+    """
+    units = WeakKeyDictionary()
+
+    def __init__(self, app):
+        self.app = app  # required for method_connect_once
+        self.flushing = False
+        self._steps = []
+        # Key of the batch => step open to add writes
+        self._batches = {}
+        # Objects with PendingKey
+        self._created = []
+        self._task = None
+        self._previous = None
+
+    @classmethod
+    def current(cls):
+        """Returns unit of work of the current task or None"""
+        task = _current_task()
+        if task is not None:
+            return cls.units.get(task)
+
+    @classmethod
+    def _active(cls, target):
+        """Returns unit of work collecting writes of the model or None"""
+        uow = cls.current()
+        if uow is None or uow.flushing or uow.app is not target.app:
+            return
+        return uow
+
+    def __len__(self):
+        return len(self._steps)
+
+    async def __aenter__(self):
+        self._task = _current_task()
+        if self._task is None:
+            raise RuntimeError('UnitOfWork should be used within task')
+        self._previous = self.units.get(self._task)
+        self.units[self._task] = self
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                await self.flush()
+        finally:
+            if self._previous is None:
+                del self.units[self._task]
+            else:
+                self.units[self._task] = self._previous
+            self._task = self._previous = None
+            self.discard()
+
+    def discard(self):
+        """Discards pending writes"""
+        self._steps.clear()
+        self._batches.clear()
+        self._forget_created()
+
+    def _forget_created(self):
+        """Removes PendingKey of the objects which are not created"""
+        for obj in self._created:
+            pk = obj.get(obj.primary_key)
+            if isinstance(pk, PendingKey) and pk.obj is obj:
+                del obj[obj.primary_key]
+        self._created.clear()
+
+    @method_connect_once
+    async def flush(self, connection=None):
+        """Writes pending changes in one transaction"""
+        steps = self._steps
+        self._steps = []
+        self._batches.clear()
+        if not steps:
+            return
+        self.flushing = True
+        try:
+            async with AfterCommit(connection), connection.transaction():
+                for step in steps:
+                    await step.run(connection)
+        finally:
+            self.flushing = False
+            self._forget_created()
+
+    async def _flush_before(self, args, kwargs):
+        """Flushes pending writes and returns arguments of the write without PendingKey"""
+        if self._steps:
+            await self.flush(connection=kwargs.get('connection'))
+        args = tuple(_resolve_argument(i) for i in args)
+        kwargs = {k: _resolve_argument(v) for k, v in kwargs.items()}
+        return args, kwargs
+
+    def _step(self, kind, model, fields=None, values=()):
+        """
+        Returns step open to add the write.
+        The step runs after steps creating objects referenced by PendingKey in values.
+        """
+        key = kind, model, fields
+        step = self._batches.get(key)
+        if step is not None:
+            index = self._steps.index(step)
+            for v in values:
+                if isinstance(v, PendingKey) and v.step in self._steps \
+                        and self._steps.index(v.step) >= index:
+                    step = None
+                    break
+        if step is None:
+            step = self._batches[key] = _Step(kind, model, fields)
+            self._steps.append(step)
+        return step
+
+    def _close(self, model, kinds, fields=None):
+        """Closes batches of the model, so later writes are not moved before earlier ones"""
+        for key in list(self._batches):
+            kind, batch_model, batch_fields = key
+            if batch_model is not model or kind not in kinds:
+                continue
+            elif fields is None or set(fields).intersection(batch_fields or ()):
+                del self._batches[key]
+
+    def _insert(self, obj):
+        step = self._step('insert', type(obj), values=obj.values())
+        step.rows.setdefault(id(obj), obj)
+        if obj.primary_key not in obj:
+            obj[obj.primary_key] = PendingKey(obj, step)
+            self._created.append(obj)
+
+    def _create(self, model, **kwargs):
+        model.set_defaults(kwargs)
+        obj = model(**kwargs)
+        self._insert(obj)
+        return obj
+
+    def _save(self, obj, *, fields=None, upsert=None):
+        if upsert is None:
+            upsert = obj.use_upsert
+        obj.set_defaults(obj)
+        if obj.primary_key not in obj:
+            self._insert(obj)
+            return obj.pk
+        elif isinstance(obj.pk, PendingKey):
+            # Object is inserted as it is at flush
+            return obj.pk
+        values = {
+            k: v for k, v in obj._values_to_update(fields).items()
+            if k != obj.primary_key
+        }
+        self._close(type(obj), ('json',), values)
+        if upsert:
+            # Whole object is inserted when it does not exist
+            step = self._step('upsert', type(obj), tuple(sorted(values)), obj.values())
+            step.rows[obj.pk] = dict(obj)
+        elif values:
+            step = self._step('update', type(obj), tuple(sorted(values)), values.values())
+            row = step.rows.setdefault(obj.pk, {obj.primary_key: obj.pk})
+            row.update(values)
+        return obj.pk
+
+    def _update_json(self, obj, *args, **kwargs):
+        if obj.primary_key not in obj:
+            raise ValueError('Object {!r} should be saved before update_json'.format(obj))
+        values = obj._json_values(args, kwargs)
+        self._close(type(obj), ('update', 'upsert'), values)
+        key = 'json', type(obj), tuple(sorted(values))
+        row = self._batches[key].rows.get(obj.pk) if key in self._batches else None
+        if row is not None and not all(
+                isinstance(row[k], dict) and isinstance(v, dict)
+                for k, v in values.items()):
+            # Only objects are merged, other values are written by next statement
+            del self._batches[key]
+            row = None
+        if row is None:
+            step = self._step(*key, values=(obj.pk,))
+            row = step.rows.setdefault(obj.pk, {obj.primary_key: obj.pk})
+        for k, v in values.items():
+            if k in row:
+                # Top level keys of the later object replace former ones like ||
+                v = dict(row[k], **v)
+            row[k] = v
+
+    def _update_fields(self, model, where, **kwargs):
+        self._close(model, ('insert', 'update', 'upsert', 'json'))
+        step = _Step('fields', model, where=where)
+        step.rows = kwargs
+        self._steps.append(step)
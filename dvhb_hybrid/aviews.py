@@ -2,6 +2,7 @@ import datetime
 import functools
 import json
 import uuid
+from collections.abc import Mapping
 
 from aiohttp import web
 from aiohttp_apiset.views import ApiSet
@@ -26,6 +27,8 @@ class JsonEncoder(json.JSONEncoder):
             return str(o)
         elif isinstance(o, (map, set, frozenset)):
             return list(o)
+        elif isinstance(o, Mapping):
+            return dict(o)
         else:
             return super(JsonEncoder, self).default(o)
 
@@ -65,6 +68,20 @@ class BaseView(RedisMixin, ApiSet):
             pass
         return limit, offset
 
+    def page_params(self, data: dict, limit=10, model=None, sort=None):
+        """
+        Returns limit and token of the page for keyset pagination.
+        Token is checked when model given.
+        """
+        limit, _ = self.list_params(data, limit=limit)
+        after = data.get('after') or None
+        if after is not None and model is not None:
+            try:
+                model.decode_page_token(after, sort)
+            except ValueError as e:
+                raise web.HTTPBadRequest(reason=str(e))
+        return limit, after
+
 
 def response_file(url, mime_type, filename=None):
     headers = {'X-Accel-Redirect': url}
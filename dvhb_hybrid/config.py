@@ -21,7 +21,7 @@ def convert_to_djangodb(d, name, base_dir='/tmp'):
         db = {
             k.upper(): v
             for k, v in d.items()
-            if v}
+            if v and k not in ('replicas', 'read_your_writes', 'idle_release')}
         if db.pop('GIS', None):
             db['ENGINE'] = 'django.contrib.gis.db.backends.postgis'
         else:
@@ -88,26 +88,62 @@ async def cleanup_ctx_aiopg(app, cfg_key='default', app_key='db'):
         yield
 
 
+def _pool_args(dbparams):
+    if 'uri' in dbparams:
+        return (dbparams['uri'],), {}
+    return (), {
+        k: v for k, v in dbparams.items()
+        if k not in ('replicas', 'read_your_writes', 'idle_release')}
+
+
 async def cleanup_ctx_databases(app, cfg_key='default', app_key='db'):
+    """
+    Creates pool of the database and pools of its replicas if any.
+    Replicas are listed in replicas of the database config in the same form.
+    Reads of the models go to replicas except read_your_writes seconds
+    (5 by default) after write of the task.
+    Lazy connection of the request is released after idle_release seconds
+    without queries when it is set.
+    """
     import asyncpgsa
     from dvhb_hybrid.amodels import AppModels
+    from dvhb_hybrid.amodels.replicas import ReplicaRouter
 
     app.models = app.m = AppModels(app)
 
     async def init(connection):
-        for t in ['json', 'jsonb']:
-            await connection.set_type_codec(
-                t,
-                encoder=lambda x: x,
-                decoder=json.loads,
-                schema='pg_catalog',
-            )
+        # Binary format is required by COPY (Model.create_many(copy=True)).
+        # Values are serialized to JSON string by SQLAlchemy.
+        await connection.set_type_codec(
+            'json',
+            encoder=str.encode,
+            decoder=json.loads,
+            schema='pg_catalog',
+            format='binary',
+        )
+        # Binary jsonb is prefixed by version of the format
+        await connection.set_type_codec(
+            'jsonb',
+            encoder=lambda x: b'\x01' + x.encode(),
+            decoder=lambda x: json.loads(x[1:]),
+            schema='pg_catalog',
+            format='binary',
+        )
     dbparams = app.context.config.databases.get(cfg_key)
-    if 'uri' in dbparams:
-        dbargs, dbkwargs = (dbparams.uri,), {}
-    else:
-        dbargs, dbkwargs = (), dbparams
+    dbargs, dbkwargs = _pool_args(dbparams)
 
     async with asyncpgsa.create_pool(*dbargs, init=init, **dbkwargs) as pool:
         app[app_key] = pool
-        yield
+        app[app_key + '_idle_release'] = dbparams.get('idle_release')
+        replicas = []
+        try:
+            for replica in dbparams.get('replicas') or ():
+                dbargs, dbkwargs = _pool_args(replica)
+                replicas.append(await asyncpgsa.create_pool(*dbargs, init=init, **dbkwargs))
+            if replicas:
+                app[app_key + '_router'] = ReplicaRouter(
+                    pool, replicas, window=dbparams.get('read_your_writes', 5))
+            yield
+        finally:
+            for replica in replicas:
+                await replica.close()
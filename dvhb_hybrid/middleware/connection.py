@@ -0,0 +1,15 @@
+from dvhb_hybrid.amodels import LazyConnection
+
+
+async def lazy_connection_factory(app, handler):
+    """
+    Shares lazy database connection within each request.
+    It is released when response is ready or after idle_release seconds
+    of the database config without queries.
+    """
+    idle = app.get('db_idle_release')
+
+    async def lazy_connection_middleware(request):
+        async with LazyConnection(app, idle=idle):
+            return await handler(request)
+    return lazy_connection_middleware
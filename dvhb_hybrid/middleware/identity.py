@@ -0,0 +1,11 @@
+from dvhb_hybrid.amodels import IdentityMap
+
+
+async def identity_map_factory(app, handler):
+    """
+    Enables identity map of models for each request
+    """
+    async def identity_map_middleware(request):
+        with IdentityMap():
+            return await handler(request)
+    return identity_map_middleware
@@ -4,6 +4,7 @@ import xml.etree.cElementTree as ET
 from aiohttp import web
 
 from . import amodels
+from .amodels.cache import two_tier
 
 doctype = '<?xml version="1.0" encoding="UTF-8"?>'
 content_type = 'application/xml'
@@ -30,7 +31,7 @@ async def sitemap(request, redis, *, key, data):
     else:
         key = ':'.join(['sitemap', key])
 
-    body = await redis.get(key)
+    body = await two_tier.get(redis, key)
     if body:
         return web.Response(body=body, content_type=content_type)
 
@@ -38,8 +39,7 @@ async def sitemap(request, redis, *, key, data):
         data = await data
     body = get_xml(request, data)
     body = '\n'.join([doctype, body])
-    await redis.set(key, body)
-    await redis.expire(key, 3600)
+    await two_tier.set(redis, key, body, expire=3600)
     return web.Response(text=body, content_type=content_type)
 
 
@@ -11,3 +11,17 @@ class MPTTTestModel(CreatedMixin, MPTTModel):
 
     class MPTTMeta:
         order_insertion_by = ['name']
+
+
+class LocalizedTestModel(models.Model):
+    # Columns of the languages like modeltranslation adds
+    title = models.TextField(null=True, blank=True)
+    title_en = models.TextField(null=True, blank=True)
+    title_ru = models.TextField(null=True, blank=True)
+
+
+class BulkTestModel(models.Model):
+    code = models.CharField(max_length=5)
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    # Column without SQLAlchemy type
+    content = models.BinaryField(null=True)
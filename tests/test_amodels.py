@@ -1,12 +1,28 @@
 import asyncio
+from decimal import Decimal
+from functools import partial
 from uuid import uuid4
 
+import asyncpg
 import asyncpgsa
 import pytest
 import sqlalchemy as sa
 
 from dvhb_hybrid import exceptions
-from dvhb_hybrid.amodels import Model
+from dvhb_hybrid.amodels import (
+    JSON_DELETE,
+    IdentityMap,
+    LazyConnection,
+    Model,
+    derive_from_django,
+    method_connect_once,
+)
+from dvhb_hybrid.amodels.cache import RedisCached, TwoTierCache, two_tier
+from dvhb_hybrid.amodels.commit import AfterCommit
+from dvhb_hybrid.amodels.model import ColumnDescriptor
+from dvhb_hybrid.amodels.unit_of_work import PendingKey
+
+from . import models
 
 
 class Model1(Model):
@@ -28,6 +44,13 @@ def model(app):
     return Model1.factory(app)
 
 
+@pytest.fixture(autouse=True)
+def local_cache():
+    # Values of the fake redis should not outlive the test
+    yield
+    two_tier.local.clear()
+
+
 async def test_create(model, app, aiohttp_client):
     await aiohttp_client(app)
     obj = await model.create(text='123', data={'1': 2, '3': '4'})
@@ -49,12 +72,165 @@ async def test_count(app, mocker, model, aiohttp_client):
     assert await model.get_count(
         redis=mocker.Mock(
             get=asyncio.coroutine(lambda x: None),
-            set=asyncio.coroutine(lambda x, v: None),
+            set=asyncio.coroutine(lambda x, v, **kwargs: True),
             expire=asyncio.coroutine(lambda x, v: None),
+            eval=asyncio.coroutine(lambda *args, **kwargs: None),
         )
     )
 
 
+class FakeRedis:
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, exist=None, **kwargs):
+        if exist and key in self.data:
+            return False
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        self.data[key] = value
+        return True
+
+    async def eval(self, script, keys, args):
+        self.data.pop(keys[0], None)
+
+    async def incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+
+async def test_count_single_flight(app, mocker, model, aiohttp_client):
+    await aiohttp_client(app)
+    await model.create(text='123')
+    redis = FakeRedis()
+    pg_scalar = mocker.spy(model, '_pg_scalar')
+    counts = await asyncio.gather(*[model.get_count(redis=redis) for _ in range(5)])
+    assert len(set(counts)) == 1
+    assert pg_scalar.call_count == 1
+    assert await model.get_count(redis=redis) == counts[0]
+    assert pg_scalar.call_count == 1
+    # Other process computes the value
+    key = model.get_cache_key('aggregate:sum', 'total', generation=0)
+    redis.data[key + ':lock'] = b'1'
+    total = asyncio.ensure_future(model.get_sum(
+        'id', model.table.c.id > 0, postfix='total', delay=10, redis=redis))
+    await asyncio.sleep(0.01)
+    assert not total.done()
+    redis.data[key] = b'5'
+    assert await total == 5
+
+
+async def test_count_estimate(app, mocker, model, aiohttp_client):
+    await aiohttp_client(app)
+    obj = await model.create(text='123')
+    async with app['db'].acquire() as connection:
+        await connection.execute('ANALYZE test')
+    redis = mocker.Mock()
+    assert await model.get_count(estimate=True, expire=0, redis=redis) > 0
+    where = model.table.c.id == obj.pk
+    assert await model.get_count(where, estimate=True, expire=0, redis=redis) >= 1
+    assert await model.get_count(
+        where, estimate=True, exact_below=1000, expire=0, redis=redis) == 1
+
+
+async def test_count_generation(app, mocker, model, aiohttp_client):
+    await aiohttp_client(app)
+    redis = FakeRedis()
+    invalidate_cache = model.invalidate_cache
+    invalidate = mocker.patch.object(
+        model, 'invalidate_cache', side_effect=lambda **kwargs: invalidate_cache(redis=redis, **kwargs))
+    where = model.table.c.text == 'generation'
+    assert await model.get_count(where, redis=redis, expire=3600) == 0
+    obj = await model.create(text='generation')
+    assert invalidate.call_count == 1
+    assert await model.get_count(where, redis=redis, expire=3600) == 1
+    await obj.delete()
+    assert await model.get_count(where, redis=redis, expire=3600) == 0
+    # Readers may cache count before commit, so generation is bumped again after it
+    key = model.get_cache_key('generation')
+    async with app['db'].acquire() as connection:
+        async with AfterCommit(connection), connection.transaction():
+            await model.create(text='generation', connection=connection)
+            await model.create(text='generation', connection=connection)
+            generation = int(redis.data[key])
+        assert int(redis.data[key]) == generation + 1
+        # Generation is not bumped again after rollback
+        with pytest.raises(ZeroDivisionError):
+            async with AfterCommit(connection), connection.transaction():
+                await model.create(text='generation', connection=connection)
+                generation = int(redis.data[key])
+                1 / 0
+        assert int(redis.data[key]) == generation
+
+
+async def test_generation_redis_down(app, mocker, model, aiohttp_client):
+    await aiohttp_client(app)
+    redis = FakeRedis()
+    mocker.patch.object(redis, 'incr', side_effect=ConnectionRefusedError)
+    invalidate_cache = model.invalidate_cache
+    mocker.patch.object(
+        model, 'invalidate_cache', side_effect=lambda **kwargs: invalidate_cache(redis=redis, **kwargs))
+    obj = await model.create(text='generation')
+    assert redis.incr.call_count == 1
+    assert (await model.get_one(obj.pk)).text == 'generation'
+    await obj.delete()
+
+
+async def test_count_connection(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    redis = FakeRedis()
+    where = model.table.c.text == 'count connection'
+    async with app['db'].acquire() as connection:
+        transaction = connection.transaction()
+        await transaction.start()
+        try:
+            await model.create(text='count connection', connection=connection)
+            # Count within transaction is not shared with other callers
+            result = await asyncio.gather(
+                model.get_count(where, redis=redis, connection=connection),
+                model.get_count(where, redis=redis))
+        finally:
+            await transaction.rollback()
+    assert result == [1, 0]
+
+
+async def test_count_key(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    redis = FakeRedis()
+    t = model.table
+    await model.get_count(t.c.text == '1', redis=redis)
+    await model.get_count(t.c.text == '2', redis=redis)
+    await model.get_count(t.c.text == '1', redis=redis)
+    keys = [k for k in redis.data if ':count:' in k]
+    assert len(keys) == 2
+    assert all(len(k.rsplit(':', 1)[-1]) == 32 for k in keys)
+
+
+async def test_count_two_tier(app, mocker, model, aiohttp_client):
+    await aiohttp_client(app)
+    redis = FakeRedis()
+    get = mocker.spy(redis, 'get')
+    mocker.patch.object(RedisCached, 'cache', TwoTierCache())
+    count = await model.get_count(redis=redis)
+    calls = get.call_count
+    assert await model.get_count(redis=redis) == count
+    # Generation is read from Redis, count from memory
+    assert get.call_count == calls + 1
+    stats = RedisCached.cache.stats()
+    assert stats['local']['hits'] == 1
+    assert stats['redis']['misses'] == 1
+    # Other process writes the model, its generation is seen at once
+    await model.create(text='two tier')
+    await redis.incr(model.get_cache_key('generation'))
+    assert await model.get_count(redis=redis) == count + 1
+
+
 async def test_save(app, model, aiohttp_client):
     await aiohttp_client(app)
     obj = model(text='123')
@@ -79,6 +255,183 @@ async def test_get_or_create(app, model, aiohttp_client):
     assert not created
 
 
+async def test_upsert(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    obj = model(text='123')
+    assert await obj.upsert()
+    obj.text = '321'
+    assert not await obj.upsert(fields=['text'])
+    obj2 = await model.get_one(obj.pk)
+    assert obj2.text == '321'
+
+    xmin = 'SELECT xmin::text FROM test WHERE id = $1'
+    async with app['db'].acquire() as connection:
+        version = await connection.fetchval(xmin, obj.pk)
+        obj3, created = await model.get_or_create(
+            obj.pk, defaults={'text': '1'}, conflict=['id'], connection=connection)
+        assert not created
+        assert obj3.text == '321'
+        # Existing row is not written
+        assert await connection.fetchval(xmin, obj.pk) == version
+
+
+async def test_identity_map(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    obj = await model.create(text='123')
+    t = model.table
+    with IdentityMap() as identity_map:
+        assert (await model.get_one(obj.pk)).text == '123'
+        assert len(identity_map) == 1
+        # Change row bypassing the model
+        async with app['db'].acquire() as connection:
+            await connection.execute(t.update().where(t.c.id == obj.pk).values(text='321'))
+        connected = mocker.spy(model, '_get_one_connected')
+        assert (await model.get_one(obj.pk)).text == '123'
+        assert (await model.get_one(str(obj.pk))).text == '123'
+        # Rows are found without connection
+        assert not connected.called
+        assert (await model.get_dict([obj.pk]))[obj.pk].text == '123'
+        # Keys of found and fetched rows are primary keys of the same type
+        other = await model.create(text='other')
+        result = await model.get_dict([str(obj.pk), str(other.pk)])
+        assert result == {obj.pk: {'id': obj.pk, 'text': '123', 'data': None},
+                          other.pk: {'id': other.pk, 'text': 'other', 'data': None}}
+        await model.update_fields(t.c.id == obj.pk, text='111')
+        assert (await model.get_one(obj.pk)).text == '111'
+    assert IdentityMap.current() is None
+
+
+async def test_batch_get_one(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    objs = [await model.create(text=str(i)) for i in range(3)]
+    model.batch_get_one = True
+    model.loader_max_size = 2
+    get_list = mocker.spy(model, 'get_list')
+    pks = [i.pk for i in objs]
+    result = await asyncio.gather(*[model.get_one(pk) for pk in pks + pks[:1]])
+    assert [i.text for i in result] == ['0', '1', '2', '0']
+    assert result[0] is not result[-1]
+    assert get_list.call_count == 2
+    with pytest.raises(exceptions.NotFound):
+        await model.get_one(max(pks) + 1)
+    assert await model.get_one(max(pks) + 1, silent=True) is None
+    obj = await model.get_one(pks[0], fields=['text'])
+    assert obj.text == '0'
+    # Lists of the model are compact, objects of the loader are not
+    model.compact_rows = True
+    obj = await model.get_one(pks[1])
+    assert isinstance(obj, model)
+    assert obj.text == '1'
+
+
+async def test_update_many(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    objs = await model.create_many([dict(text=str(i), data={'i': i}) for i in range(5)])
+    for obj in objs:
+        obj.text += '!'
+        obj.data = {'j': obj.data['i']}
+    await model.update_many(objs, fields=['text', 'data'], chunk_size=2)
+    pks = [obj.pk for obj in objs]
+    result = await model.get_list(model.table.c.id.in_(pks), sort='id')
+    assert [i.text for i in result] == ['0!', '1!', '2!', '3!', '4!']
+    assert result[4].data == {'j': 4}
+    objs[0].text = 'returning'
+    result = await model.update_many(objs[:1], fields=['text'], returning=True)
+    assert [i.text for i in result] == ['returning']
+    with pytest.raises(ValueError):
+        await model.update_many([{'id': pks[0]}])
+
+
+async def test_upsert_many(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    obj = await model.create(text='1')
+    result = await model.upsert_many(
+        [dict(id=obj.pk, text='2'), dict(id=obj.pk + 1000, text='3')], returning=True)
+    assert [i.text for i in result] == ['2', '3']
+    result = await model.upsert_many(
+        [dict(id=obj.pk, text='4')], fields=['id'], returning=True)
+    assert result == []
+    assert (await model.get_one(obj.pk)).text == '2'
+    await model.delete_where(model.table.c.id == obj.pk + 1000)
+
+
+async def test_replicas(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    router = app['db_router']
+    pool = router.pool
+    replica = []
+
+    def record(**kwargs):
+        result = pool(**kwargs)
+        replica.append(result is router.replicas[0])
+        return result
+
+    mocker.patch.object(router, 'pool', side_effect=record)
+    await model.get_list(limit=1)
+    await model.get_list(limit=1, use_primary=True)
+    assert replica == [True, False]
+
+    async def write_and_read():
+        obj = await model.create(text='replica')
+        return await model.get_one(obj.pk)
+
+    # Task reads own writes from primary
+    assert (await asyncio.ensure_future(write_and_read())).text == 'replica'
+    assert replica == [True, False, False, False]
+
+    @method_connect_once
+    async def acquire(model, connection=None):
+        return await connection.fetchval('SELECT 1')
+
+    async def acquire_and_read():
+        await acquire(model)
+        return await model.get_list(limit=1)
+
+    # Connection to primary without write does not turn reads of the task to it
+    await asyncio.ensure_future(acquire_and_read())
+    assert replica == [True, False, False, False, False, True]
+
+
+async def test_result_cache(app, model, aiohttp_client, mocker):
+    app['redis'] = FakeRedis()
+    await aiohttp_client(app)
+    text = str(uuid4())
+    obj = await model.create(text=text)
+    fetch = mocker.spy(model, '_fetch')
+    prepare = mocker.spy(model, '_prepare_select')
+    where = model.table.c.text == text
+    for i in range(2):
+        l = await model.get_list(where, cache=10)
+        assert [i.pk for i in l] == [obj.pk]
+        assert (await model.get_one(obj.pk, cache=True)).text == text
+        assert list(await model.get_dict([obj.pk], cache=10)) == [obj.pk]
+    assert fetch.call_count == 3
+    # Cached rows are returned without preparing statement
+    assert prepare.call_count == 3
+    await model.create(text=text)
+    assert len(await model.get_list(where, cache=10)) == 2
+    assert fetch.call_count == 4
+    with pytest.raises(exceptions.NotFound):
+        await model.get_one(0, cache=10)
+
+
+async def test_load_fields_many(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    objs = await model.create_many([dict(text=str(i), data={'i': i}) for i in range(3)])
+    pks = [i.pk for i in objs]
+    l = await model.get_list(model.table.c.id.in_(pks), fields=['id'], sort='id')
+    l[0]['text'] = 'changed'
+    fetch = mocker.spy(model, '_prepare_select')
+    await model.load_fields_many(l, 'text', 'data')
+    assert fetch.call_count == 1
+    assert [i.text for i in l] == ['changed', '1', '2']
+    assert l[2].data == {'i': 2}
+    await model.load_fields_many(l, 'text', force_update=True)
+    assert l[0].text == '0'
+    await model.load_fields_many(l, 'text')
+    assert fetch.call_count == 2
+
+
 async def test_list(app, model, aiohttp_client):
     await aiohttp_client(app)
     l = await model.get_list(
@@ -88,6 +441,31 @@ async def test_list(app, model, aiohttp_client):
     assert isinstance(l, list)
 
 
+async def test_list_compact(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    obj = await model.create(text='123')
+    l = await model.get_list(model.table.c.id == obj.pk, compact=True)
+    assert len(l) == 1
+    row = l[0]
+    assert row.pk == obj.pk
+    assert row.text == '123'
+    assert dict(row) == dict(obj, data=None)
+    row.text = '321'
+    await row.save()
+    assert (await model.get_one(obj.pk)).text == '321'
+
+
+async def test_iter_list(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    await model.create(text='123')
+    expected = [o.pk for o in await model.get_list(fields=['id'], sort='id')]
+    result = [o.pk async for o in model.iter_list(fields=['id'], sort='id')]
+    assert result == expected
+    batches = [b async for b in model.iter_list(fields=['id'], sort='id', batch_size=2)]
+    assert all(len(b) <= 2 for b in batches)
+    assert [o.pk for b in batches for o in b] == expected
+
+
 async def test_dict(app, model, aiohttp_client):
     await aiohttp_client(app)
     ids = [o.pk for o in await model.get_list(fields=['id'])]
@@ -117,6 +495,16 @@ async def test_create_many(app, model, aiohttp_client):
     assert all('id' in i for i in result)
 
 
+async def test_create_many_copy(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    objects = ({'text': str(i), 'data': {'i': i}} for i in range(5))
+    result = await model.create_many(objects, copy=True, chunk_size=2)
+    assert len(result) == 5
+    assert len({i.pk for i in result}) == 5
+    r = await model.get_one(result[-1].pk)
+    assert r['data'] == {'i': 4}
+
+
 async def test_create_delete(app, model, new_object, aiohttp_client):
     await aiohttp_client(app)
     obj = await model.create(**new_object)
@@ -157,3 +545,301 @@ async def test_validate_and_save(app, model, new_object, aiohttp_client):
     # Valid update
     o = await m.get_one(o.pk, fields=['id'])
     await o.validate_and_save({})
+
+
+def test_statement_cache():
+    Model1.get_statement_cache().clear()
+    sql1, params1 = Model1._prepare_select(where=Model1.table.c.id == 1, limit=10)
+    sql2, params2 = Model1._prepare_select(where=Model1.table.c.id == 2, limit=20)
+    assert sql1 == sql2
+    assert params1 == [1, 10]
+    assert params2 == [2, 20]
+    sql3, _ = Model1._prepare_select(where=Model1.table.c.text == '1')
+    assert sql3 != sql1
+    assert len(Model1.get_statement_cache()) == 2
+
+
+def test_page_token():
+    token = Model1.encode_page_token({'id': 5, 'text': 'a'}, sort='-text')
+    where = Model1.decode_page_token(token, sort='-text')
+    assert where is not None
+    with pytest.raises(ValueError):
+        Model1.decode_page_token(token, sort='text')
+    with pytest.raises(ValueError):
+        Model1.decode_page_token(token + '1', sort='-text')
+
+
+async def test_get_page(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    for i in range(3):
+        await model.create(text=str(i))
+    expected = [o.pk for o in await model.get_list(fields=['id'], sort='id')]
+    result = []
+    page, after = await model.get_page(limit=2, sort='id')
+    result.extend(o.pk for o in page)
+    while after:
+        page, after = await model.get_page(limit=2, sort='id', after=after)
+        result.extend(o.pk for o in page)
+    assert result == expected
+
+
+async def test_lazy_connection(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    router = mocker.spy(app['db_router'], 'pool')
+
+    async def request():
+        async with LazyConnection(app, idle=0.05) as connection:
+            assert LazyConnection.current() is connection
+            # Reads go to replica by own connection
+            await model.get_list(limit=1)
+            assert not connection.acquired
+            obj = await model.create(text='lazy')
+            assert connection.acquired
+            # Reads of own writes share the connection
+            assert (await model.get_one(obj.pk)).text == 'lazy'
+            await asyncio.sleep(0.1)
+            assert not connection.acquired
+            await obj.delete()
+            assert connection.acquired
+        assert not connection.acquired
+        assert LazyConnection.current() is None
+
+    await asyncio.ensure_future(request())
+    assert router.call_count == 1
+
+
+async def test_lazy_transaction_reads(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    model.batch_get_one = True
+
+    async def request():
+        async with LazyConnection(app) as connection:
+            async with connection.transaction():
+                obj = await model.create(text='lazy transaction')
+                # Loader and iterator read within the transaction
+                assert (await model.get_one(obj.pk)).text == 'lazy transaction'
+                result = [o.pk async for o in model.iter_list(model.table.c.id == obj.pk)]
+                assert result == [obj.pk]
+                await obj.delete()
+
+    await asyncio.ensure_future(request())
+
+
+async def test_unit_of_work(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    obj = await model.create(text='uow', data={'a': 1})
+    other = await model.create(text='uow')
+    create_many = mocker.spy(model, 'create_many')
+    update_many = mocker.spy(model, 'update_many')
+    async with app.m.unit_of_work() as uow:
+        created = [await model.create(text='uow created') for _ in range(3)]
+        assert isinstance(created[0].pk, PendingKey)
+        obj.text = other.text = 'uow saved'
+        await obj.save(fields=['text'])
+        await other.save(fields=['text'])
+        await obj.update_json('data', 'b', 2)
+        await obj.update_json(data={'c': 3})
+        assert len(uow) == 3
+        # Nothing is written yet
+        assert (await model.get_one(obj.pk)).text == 'uow'
+    assert create_many.call_count == 1
+    assert update_many.call_count == 2
+    assert all(isinstance(i.pk, int) for i in created)
+    result = await model.get_dict([obj.pk, other.pk, created[0].pk])
+    assert result[obj.pk].text == result[other.pk].text == 'uow saved'
+    assert result[obj.pk].data == {'a': 1, 'b': 2, 'c': 3}
+    assert result[created[0].pk].text == 'uow created'
+
+
+async def test_unit_of_work_references(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    t = model.table
+    model.fields_permanent = ('data',)
+    obj = await model.create(text='uow')
+    async with app.m.unit_of_work() as uow:
+        # Calls with connection are not deferred
+        async with app['db'].acquire() as connection:
+            other = await model.create(text='uow connection', connection=connection)
+        assert isinstance(other.pk, int)
+        created = await model.create(text='uow created')
+        await created.update_json(data={'a': 1})
+        await model.update_fields(t.c.id == created.pk, text='uow updated')
+        # Permanent fields are saved only when the object has them
+        obj.text = 'uow saved'
+        await obj.save(fields=['text'])
+        assert len(uow) == 4
+    assert isinstance(created.pk, int)
+    result = await model.get_dict([obj.pk, created.pk])
+    assert result[created.pk].text == 'uow updated'
+    assert result[created.pk].data == {'a': 1}
+    assert result[obj.pk].text == 'uow saved'
+
+    # Pending key is removed from the objects which are not created
+    with pytest.raises(RuntimeError):
+        async with app.m.unit_of_work():
+            created = await model.create(text='uow discarded')
+            raise RuntimeError()
+    assert created.pk is None
+
+
+async def test_unit_of_work_immediate(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    t = model.table
+    obj = await model.create(text='uow')
+    async with app.m.unit_of_work() as uow:
+        obj.text = 'uow saved'
+        await obj.save(fields=['text'])
+        created = await model.create(text='uow created')
+        # Writes which are not deferred flush pending ones first
+        await obj.delete()
+        assert len(uow) == 0
+        assert isinstance(created.pk, int)
+        created_pk = created.pk
+        created = await model.create(text='uow created')
+        await model.delete_where(t.c.id == created.pk)
+    assert await model.get_list(t.c.id.in_([obj.pk, created.pk])) == []
+    assert (await model.get_one(created_pk)).text == 'uow created'
+
+
+async def test_gather(app, model, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    obj1 = await model.create(text='gather 1')
+    obj2 = await model.create(text='gather 2')
+    result = await app.m.gather(
+        partial(model.get_one, obj1.pk), partial(model.get_one, obj2.pk), limit=2)
+    assert [i.text for i in result] == ['gather 1', 'gather 2']
+
+    async def in_transaction():
+        async with LazyConnection(app) as connection:
+            async with connection.transaction():
+                obj = await model.create(text='gather 3')
+                # Other connections would not see the object
+                return await app.m.gather(partial(model.get_one, obj.pk), partial(model.get_one, obj1.pk))
+
+    result = await asyncio.ensure_future(in_transaction())
+    assert [i.text for i in result] == ['gather 3', 'gather 1']
+
+    @method_connect_once
+    async def with_connection(model, connection=None):
+        pool = mocker.spy(app['db_router'], 'pool')
+        result = await app.m.gather(
+            partial(model.get_one, obj1.pk), partial(model.get_one, obj2.pk),
+            connection=connection)
+        # Reads use connection of the caller
+        assert not pool.called
+        return result
+
+    result = await with_connection(model)
+    assert [i.text for i in result] == ['gather 1', 'gather 2']
+
+
+async def test_update_json_paths(app, model, aiohttp_client):
+    await aiohttp_client(app)
+    obj1 = await model.create(text='paths', data={'a': {'b': 1, 'c': 2}, 'd': 3})
+    obj2 = await model.create(text='paths')
+    await model.update_json_paths([obj1, obj2.pk], {
+        ('data', 'a', 'b'): 10,
+        ('data', 'e', 'f', 'g'): 'new',
+        ('data', 'd'): JSON_DELETE,
+    })
+    result = await model.get_dict([obj1.pk, obj2.pk])
+    assert result[obj1.pk].data == {'a': {'b': 10, 'c': 2}, 'e': {'f': {'g': 'new'}}}
+    assert result[obj2.pk].data == {'a': {'b': 10}, 'e': {'f': {'g': 'new'}}}
+    await model.update_json_paths(model.table.c.id == obj1.pk, {'data': {'x': 1}})
+    assert (await model.get_one(obj1.pk)).data == {'x': 1}
+
+
+def test_column_descriptors():
+    assert isinstance(Model1.__dict__['text'], ColumnDescriptor)
+    obj = Model1(id=1, text='a')
+    assert obj.text == 'a'
+    obj.text = 'b'
+    assert obj['text'] == 'b'
+    assert getattr(obj, 'data', None) is None
+    with pytest.raises(AttributeError):
+        obj.data
+
+    class Model2(Model):
+        table = sa.table('test2', sa.column('id'), sa.column('save'))
+
+    # Names of model attributes are not replaced
+    assert Model2(save=1).save.__name__ == 'save'
+
+
+@derive_from_django(models.LocalizedTestModel)
+class LocalizedModel(Model):
+    fields_localized = ['title']
+
+
+@pytest.mark.django_db
+async def test_localized(app, aiohttp_client):
+    await aiohttp_client(app)
+    model = LocalizedModel.factory(app)
+    obj1 = await model.create(title='default', title_en='english', title_ru='')
+    obj2 = await model.create(title='default', title_ru='russian')
+    where = model.table.c.id.in_([obj1.pk, obj2.pk])
+    result = await model.get_list(where, sort='id', locale='ru')
+    assert [dict(i) for i in result] == [
+        {'id': obj1.pk, 'title': 'default'},
+        {'id': obj2.pk, 'title': 'russian'},
+    ]
+    obj = await model.get_one(obj1.pk, locale='en', fields=['title'])
+    assert dict(obj) == {'title': 'english'}
+    obj = await model.get_one(obj1.pk)
+    assert obj.title_en == 'english'
+
+
+@pytest.mark.django_db
+async def test_get_page_nulls(app, aiohttp_client):
+    await aiohttp_client(app)
+    model = LocalizedModel.factory(app)
+    objs = [await model.create(title=t) for t in ('b', None, 'a', None, 'b')]
+    where = model.table.c.id.in_([o.pk for o in objs])
+    # Nulls are last in ascending order and first in descending one
+    values = sorted((o.title is None, o.title or '', o.pk) for o in objs)
+    expected = {
+        'title': [pk for _, _, pk in values],
+        '-title': [pk for _, _, pk in reversed(values)],
+    }
+    for sort, pks in expected.items():
+        result = []
+        after = None
+        while True:
+            page, after = await model.get_page(where, limit=2, sort=sort, after=after)
+            result.extend(o.pk for o in page)
+            if not after:
+                break
+        assert result == pks, sort
+
+
+@derive_from_django(models.BulkTestModel)
+class BulkModel(Model):
+    pass
+
+
+def test_page_token_not_null():
+    obj = {'id': 1, 'code': 'a', 'price': 1.5}
+    # Columns derived from NOT NULL fields are compared as row
+    token = BulkModel.encode_page_token(obj, sort='code')
+    where = str(BulkModel.decode_page_token(token, sort='code'))
+    assert where.startswith('(') and 'IS NULL' not in where
+    token = BulkModel.encode_page_token(obj, sort='price')
+    assert 'IS NULL' in str(BulkModel.decode_page_token(token, sort='price'))
+
+
+@pytest.mark.django_db
+async def test_update_many_types(app, aiohttp_client):
+    await aiohttp_client(app)
+    model = BulkModel.factory(app)
+    obj = await model.create(code='a', price=Decimal('1.50'), content=b'1')
+    obj.price = Decimal('2.25')
+    obj.content = b'2'
+    await model.update_many([obj], fields=['price', 'content'])
+    result = await model.get_one(obj.pk)
+    assert result.price == Decimal('2.25')
+    assert bytes(result.content) == b'2'
+    # Long value is not truncated to the length of the column
+    obj.code = 'too long'
+    with pytest.raises(asyncpg.exceptions.StringDataRightTruncationError):
+        await model.update_many([obj], fields=['code'])
+    assert (await model.get_one(obj.pk)).code == 'a'
@@ -1,6 +1,7 @@
 import pytest
 from dvhb_hybrid import utils
 from dvhb_hybrid.amodels import Model, MPTTMixin, derive_from_django, method_connect_once
+from dvhb_hybrid.amodels.relations import DeletePlan
 
 from . import models
 
@@ -219,3 +220,50 @@ async def test_create_complex_tree(
         await fruit.get_siblings(), [meat.pk])
     assert_nodes_ids(
         await fruit.get_siblings(include_self=True), [meat.pk, fruit.pk])
+
+
+@pytest.mark.django_db
+async def test_delete_cascade(
+        clear_table, create_test_model_instance, app, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    await clear_table()
+    parent = await create_test_model_instance(name="Parent")
+    child = await create_test_model_instance(parent_id=parent.pk, name="Child")
+    grandchild1 = await create_test_model_instance(parent_id=child.pk, name="GrandChild")
+    grandchild2 = await create_test_model_instance(parent_id=child.pk, name="GrandChild2")
+    other = await create_test_model_instance(name="Other")
+    delete_related = mocker.spy(DeletePlan, 'delete_related')
+    await parent.delete()
+    # Every level of the tree is deleted at once
+    assert [sorted(c[0][1]) for c in delete_related.call_args_list] == [
+        [parent.pk], [child.pk], sorted([grandchild1.pk, grandchild2.pk])]
+    model = MPTTTestModel.factory(app)
+    assert [i.pk for i in await model.get_list()] == [other.pk]
+
+
+@pytest.mark.django_db
+async def test_prefetch(
+        clear_table, create_test_model_instance, app, aiohttp_client, mocker):
+    await aiohttp_client(app)
+    await clear_table()
+    parent = await create_test_model_instance(name="Parent")
+    child = await create_test_model_instance(parent_id=parent.pk, name="Child")
+    grandchild1 = await create_test_model_instance(parent_id=child.pk, name="GrandChild")
+    grandchild2 = await create_test_model_instance(parent_id=child.pk, name="GrandChild2")
+    other = await create_test_model_instance(name="Other")
+    model = MPTTTestModel.factory(app)
+    objects = await model.get_list(sort=['name'], compact=True)
+    get_list = mocker.spy(model.mptttestmodel.model_to, 'get_list')
+    objects = await model.prefetch(objects, 'mptttestmodel__mptttestmodel', 'parent')
+    # One query per level of relationships
+    assert get_list.call_count == 3
+    objects = {i.name: i for i in objects}
+    assert [i.pk for i in objects['Parent'].mptttestmodel] == [child.pk]
+    assert sorted(i.pk for i in objects['Parent'].mptttestmodel[0].mptttestmodel) == sorted(
+        [grandchild1.pk, grandchild2.pk])
+    assert objects['Other'].mptttestmodel == []
+    assert objects['Parent'].parent is None
+    assert objects['GrandChild'].parent.pk == child.pk
+    # Prefetched objects are not fields
+    assert 'parent' not in objects['GrandChild']
+    assert other.pk in [i.pk for i in objects.values()]